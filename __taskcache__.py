@@ -0,0 +1,152 @@
+################################################
+# https://github.com/chris-garrett/python-task #
+################################################
+#
+# Reference server for the remote task cache used by `./task --cache-url`. Not needed to run tasks.
+#
+# Stores action results under <dir>/ac/<key> and output archives under <dir>/cas/<sha256>, the same
+# layout as bazel's HTTP remote cache. Uploads to /cas are rejected unless their sha256 matches the path.
+#
+#     python -m __taskcache__ --host 127.0.0.1 --port 9090 --dir .task-cache
+#     ./task --cache-url http://127.0.0.1:9090 build
+
+import argparse
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger("taskcache")
+
+_PATH = re.compile(r"^/(ac|cas)/([0-9a-f]{64})$")
+
+
+class CacheRequestHandler(BaseHTTPRequestHandler):
+    server_version = "taskcache"
+
+    def _path(self):
+        match = _PATH.match(self.path)
+        if not match:
+            self.send_error(400, "expected /ac/<sha256> or /cas/<sha256>")
+            return None, None
+        kind, key = match.groups()
+        return os.path.join(self.server.root, kind, key), (kind, key)
+
+    def do_HEAD(self):
+        self._get(send_body=False)
+
+    def do_GET(self):
+        self._get(send_body=True)
+
+    def _get(self, send_body):
+        path, _ = self._path()
+        if path is None:
+            return
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(os.path.getsize(path)))
+        self.send_header("Content-Type", "application/octet-stream")
+        self.end_headers()
+        if send_body:
+            with open(path, "rb") as f:
+                shutil.copyfileobj(f, self.wfile)
+
+    def do_PUT(self):
+        path, parts = self._path()
+        if path is None:
+            return
+        kind, key = parts
+        remaining = int(self.headers.get("Content-Length", 0))
+
+        # write to a temp file in the same dir then rename so that readers never see a partial entry
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".upload-")
+        digest = hashlib.sha256()
+        try:
+            with os.fdopen(fd, "wb") as f:
+                while remaining > 0:
+                    chunk = self.rfile.read(min(remaining, 1024 * 1024))
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    f.write(chunk)
+                    remaining -= len(chunk)
+            if remaining > 0:
+                self.send_error(400, "incomplete body")
+                return
+            if kind == "cas" and digest.hexdigest() != key:
+                self.send_error(400, "sha256 does not match")
+                return
+            os.replace(tmp, path)
+            tmp = None
+        finally:
+            if tmp is not None:
+                os.remove(tmp)
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class CacheServer(ThreadingHTTPServer):
+    """
+    HTTP task cache storing entries under root.
+
+    Args:
+    - root (str): Directory entries are stored in.
+    - host (str, optional): Address to listen on. Defaults to 127.0.0.1.
+    - port (int, optional): Port to listen on. 0 picks a free port. Defaults to 0.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, root: str, host: str = "127.0.0.1", port: int = 0):
+        self.root = os.path.abspath(root)
+        for kind in ("ac", "cas"):
+            os.makedirs(os.path.join(self.root, kind), exist_ok=True)
+        super().__init__((host, port), CacheRequestHandler)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "CacheServer":
+        """
+        Serves requests on a background thread. Stop with shutdown().
+        """
+        threading.Thread(target=self.serve_forever, name="taskcache", daemon=True).start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(description="remote task cache")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9090)
+    parser.add_argument("--dir", default=".task-cache")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    )
+    server = CacheServer(args.dir, args.host, args.port)
+    logger.info("Serving %s on %s", server.root, server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,102 @@
 # https://github.com/chris-garrett/python-task #
 ################################################
 #
+# Oct 19 2026
+# * feat: distribute tasks across worker processes. `./task worker --listen host:port` serves the tasks of
+#         its own checkout. `./task --workers host:port,... target` coordinates: tasks, and each instance of
+#         a matrix task, are sent to idle workers whose checkout has the task once their dependencies have
+#         finished. logs and exit codes stream back to the coordinator. a task on a worker that goes away is
+#         retried on another.
+#         examples:
+#             `./task worker --listen 0.0.0.0:7070`
+#             `./task --workers build1:7070,build2:7070 test[py=3.9|3.10|3.11,db=pg|mysql]`
+#
+# * feat: add a shared remote task cache. tasks that declare inputs are keyed on their name, args, input
+#         file contents, declared env vars and source. with --cache-url (or TASK_CACHE_URL) set, a hit
+#         restores the task's outputs and exit code instead of running it. successful runs are uploaded
+#         in the background. the cache uses a bazel remote cache style layout (/ac/<key>, /cas/<sha256>).
+#         any cache error falls back to running the task. __taskcache__.py is a small reference server.
+#         example:
+#             builder.add_task(module_name, "build", _build, inputs=["src/**/*.py"], outputs=["dist"], env=["MODE"])
+#
+#             `python -m __taskcache__ --port 9090 --dir /var/cache/task &`
+#             `./task --cache-url http://localhost:9090 build`
+#
+# * feat: support `async def` tasks. they run on one event loop owned by the runner and async tasks that
+#         don't depend on each other run concurrently. ctx.aexec() is an async exec(). Ctrl-C cancels
+#         running async tasks and kills the commands they started.
+#         example:
+#             async def _wait_for_db(ctx: TaskContext):
+#                 while (await ctx.aexec("pg_isready", capture=True)).returncode != 0:
+#                     await asyncio.sleep(1)
+#
+# * feat: exec() reaps children with wait4() and reports their resource usage on ExecResult.usage
+#         (wall time, user/system cpu time and peak rss). usage is rolled up per task into the run
+#         metrics and -v / --verbose logs the most expensive commands at the end of the run.
+#         example:
+#             ret = ctx.exec("docker build .")
+#             ctx.log.info(f"peak rss {ret.usage.max_rss / 2**20:.0f}MB")
+#
+# * feat: add --metrics PATH (or TASK_METRICS) to export run metrics: per task duration, exit code, status
+#         and subprocess count plus the time spent in discovery, load, configure and resolve.
+#         paths ending in .prom or .txt are written as an OpenMetrics textfile (replaced each run),
+#         anything else is appended to as JSON lines.
+#         examples:
+#             `./task --metrics /var/lib/node_exporter/task.prom build`
+#             `TASK_METRICS=metrics.jsonl ./task build`
+#
+# * feat: add timeout to exec() and add_task(). a command that runs past its timeout has its process group
+#         sent SIGTERM, then SIGKILL, and returns an ExecResult with returncode 124 and timed_out set.
+#         a task timeout caps the time left for every exec(), aexec(), pipe() and shell command in the task and
+#         fails the task with 124. a shell session whose command times out is killed.
+#         examples:
+#             ret = ctx.exec("docker compose up --wait", timeout=120)
+#             if ret.timed_out:
+#                 ...
+#             builder.add_task(module_name, "test", _test, timeout=30 * 60)
+#
+# * feat: add matrix tasks. `|` separated argument values expand into one task instance per combination
+#         and instances run concurrently, limited by -j / --jobs (or TASK_JOBS, defaults to cpu count).
+#         a default matrix can be declared with add_task(). a summary of each instance is logged at the end.
+#         examples:
+#             `./task test[py=3.9|3.10|3.11,db=pg|mysql]`
+#             `./task -j 2 test[db=pg]`  # only overrides the db axis
+#
+#             builder.add_task(module_name, "test", _test, matrix={"py": ["3.9", "3.10"], "db": ["pg", "mysql"]})
+#
+# * feat: add capture_limit to exec() so that large output doesn't have to fit in memory. output is held
+#         in memory up to capture_limit bytes then spilled to a temp file. stdout/stderr are
+#         CapturedOutput objects with the last tail_lines lines kept for error reporting.
+#         example:
+#             ret = ctx.exec("pg_dump app", capture=True, capture_limit=64 * 1024 * 1024)
+#             if ret.returncode != 0:
+#                 ctx.log.error("\n".join(ret.stderr.tail))
+#             with ret.stdout.mmap() as data:
+#                 ...
+#             ret.stdout.path  # temp file once spilled, removed with ret.stdout.close()
+#
+# * feat: add ctx.shell() for running many small commands in one long lived bash process instead of
+#         forking a new process for each. sessions are closed when the task finishes.
+#         example:
+#             sh = ctx.shell()
+#             sh.run("mkdir -p build && cd build")
+#             ret = sh.run("git rev-parse HEAD", capture=True)
+#
+# * feat: add pipe() / ctx.pipe() to connect commands with OS pipes instead of round tripping output
+#         through python. stdin/stdout can be redirected from/to files.
+#         examples:
+#             ret = ctx.pipe(["tar -cf - images", "zstd -T0"], stdout="images.tar.zst")
+#             ret = ctx.pipe(["zstd -dc images.tar.zst", "docker load"])
+#             ret.returncodes  # [0, 0]
+#
+# * feat: log records are handed to a background writer instead of being formatted and written on the
+#         calling thread. LOG_MODE selects how task output is written:
+#           stream   - write records as they arrive (default)
+#           grouped  - buffer records per task and write them as one block when the task finishes
+#           prefixed - write records as they arrive, prefixed with [task name]
+#         LOG_LEVEL=QUIET disables logging outright and skips the writer thread.
+#         ./task only sets LOG_LEVEL=DEBUG when it isn't already set.
+#
 # Feb 12 2025
 # * feat: allow 'cmd' to be an array so that more complicated commands can be executed.
 #
@@ -87,16 +183,39 @@
 # * add support for file depenencies. see go-task for inspiration: https://taskfile.dev/usage/#prevent-unnecessary-work
 
 import argparse
+import asyncio
+import codecs
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
 import glob
+import hashlib
 import importlib.machinery
 import inspect
+import itertools
+import json
+import locale
 import logging
+import mmap
 import os
 import platform
+import queue
 import shlex
+import signal
+import socket
+import socketserver
 import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
+import time
 import typing
+import urllib.error
+import urllib.request
+import uuid
+import weakref
 from dataclasses import dataclass, field
 from logging import Logger
 from subprocess import CompletedProcess
@@ -189,6 +308,229 @@ logging.basicConfig(
 )
 logger = logging.getLogger("task")
 
+# name of the task running on the current thread / asyncio task. used to group log output.
+_current_task = contextvars.ContextVar("task", default=None)
+
+
+class LogPipeline(object):
+    """
+    Hands log records to a background writer so that tasks don't pay for formatting and I/O.
+
+    Args:
+    - stream: Where formatted records are written.
+    - formatter (logging.Formatter): Formats each record.
+    - mode (str, optional): One of stream, grouped or prefixed. Defaults to stream.
+    - batch_size (int, optional): Max number of records written with a single write(). Defaults to 256.
+    - max_buffered (int, optional): In grouped mode, a task's buffer is written once it holds this
+      many records so that long running tasks don't grow without bound. Defaults to 10000.
+    - handle_error (callable, optional): Called with the record from within the except block when a
+      record can't be formatted or written. Defaults to logging.Handler.handleError.
+    """
+
+    MODES = ("stream", "grouped", "prefixed")
+
+    def __init__(
+        self,
+        stream,
+        formatter: logging.Formatter,
+        mode="stream",
+        batch_size=256,
+        max_buffered=10000,
+        handle_error: Callable[[logging.LogRecord], None] = None,
+    ):
+        if mode not in self.MODES:
+            raise ValueError(f"log mode must be one of {', '.join(self.MODES)}, got {mode}")
+        self.stream = stream
+        self.formatter = formatter
+        self.handle_error = handle_error or logging.Handler().handleError
+        self.mode = mode
+        self.batch_size = batch_size
+        self.max_buffered = max_buffered
+        self.queue = queue.SimpleQueue()
+        self.buffers: Dict[str, List[logging.LogRecord]] = {}
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="task-log-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Writes anything still queued or buffered and stops the writer.
+        """
+        if self._thread is None:
+            return
+        self.queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def put(self, record: logging.LogRecord):
+        self.queue.put(record)
+
+    def task_done(self, task_name: str):
+        """
+        Marks the end of a task. In grouped mode its buffered records are written as one block.
+        """
+        self.queue.put(("done", task_name))
+
+    def flush(self, task_name: str = None):
+        """
+        Blocks until every record queued so far has been written. In grouped mode the records
+        buffered for task_name are written too.
+        """
+        thread = self._thread
+        if thread is None:
+            return
+        if task_name is not None:
+            self.task_done(task_name)
+        written = threading.Event()
+        self.queue.put(written)
+        while not written.wait(0.1):
+            if not thread.is_alive():
+                return
+
+    def _format(self, record: logging.LogRecord) -> str:
+        line = self.formatter.format(record)
+        task = getattr(record, "task", None)
+        if self.mode == "prefixed" and task:
+            line = f"[{task}] {line}"
+        return line + "\n"
+
+    def _error(self, record: logging.LogRecord):
+        # like Handler.emit, a bad record or a broken stream must not take the writer down with it
+        try:
+            self.handle_error(record)
+        except Exception:
+            pass
+
+    def _add(self, lines: List[typing.Tuple[logging.LogRecord, str]], records: List[logging.LogRecord]):
+        for record in records:
+            try:
+                lines.append((record, self._format(record)))
+            except Exception:
+                self._error(record)
+
+    def _write(self, lines: List[typing.Tuple[logging.LogRecord, str]]):
+        if lines:
+            try:
+                self.stream.write("".join(line for _, line in lines))
+                self.stream.flush()
+            except Exception:
+                self._error(lines[0][0])
+            lines.clear()
+
+    def _run(self):
+        lines = []
+        running = True
+        while running:
+            items = [self.queue.get()]
+            while len(items) < self.batch_size:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for item in items:
+                if item is None:
+                    running = False
+                elif isinstance(item, threading.Event):
+                    self._write(lines)
+                    item.set()
+                elif isinstance(item, tuple):
+                    self._add(lines, self.buffers.pop(item[1], []))
+                else:
+                    task = getattr(item, "task", None)
+                    if self.mode != "grouped" or task is None:
+                        self._add(lines, [item])
+                        continue
+                    buffer = self.buffers.setdefault(task, [])
+                    buffer.append(item)
+                    if len(buffer) >= self.max_buffered:
+                        self._add(lines, self.buffers.pop(task))
+
+            if not running:
+                for task in list(self.buffers.keys()):
+                    self._add(lines, self.buffers.pop(task))
+            self._write(lines)
+
+
+class _LogPipelineHandler(logging.Handler):
+    """
+    Stamps records with the current task and queues them on the pipeline. The message is rendered here,
+    like QueueHandler.prepare(), so it shows its args as they were when logged. Formatting happens on the writer.
+    """
+
+    def __init__(self, pipeline: LogPipeline):
+        super().__init__()
+        self.pipeline = pipeline
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            record.task = _current_task.get()
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info and not record.exc_text:
+                # tracebacks reference frames that may be gone by the time the writer gets to them
+                record.exc_text = self.pipeline.formatter.formatException(record.exc_info)
+            self.pipeline.put(record)
+        except Exception:
+            self.handleError(record)
+
+
+_log_pipeline: LogPipeline = None
+
+
+def _start_log_pipeline(mode: str = None) -> LogPipeline:
+    """
+    Swaps the root stream handler set up by basicConfig for a LogPipeline. With LOG_LEVEL=QUIET logging
+    is disabled instead, until _stop_log_pipeline().
+    """
+    global _log_pipeline
+
+    root = logging.getLogger()
+    if root.getEffectiveLevel() >= QUIET_LEVEL:
+        # nothing will ever be written so short circuit every logging call
+        logging.disable(QUIET_LEVEL - 1)
+        return None
+
+    handler = next((h for h in root.handlers if isinstance(h, logging.StreamHandler)), None)
+    if handler is None or _log_pipeline is not None:
+        return _log_pipeline
+
+    _log_pipeline = LogPipeline(
+        stream=handler.stream,
+        formatter=handler.formatter or logging.Formatter(),
+        mode=mode or os.environ.get("LOG_MODE", "stream").lower(),
+        handle_error=handler.handleError,
+    )
+    root.removeHandler(handler)
+    root.addHandler(_LogPipelineHandler(_log_pipeline))
+    _log_pipeline.start()
+    return _log_pipeline
+
+
+def _stop_log_pipeline():
+    global _log_pipeline
+
+    if _log_pipeline is None:
+        logging.disable(logging.NOTSET)
+        return
+    root = logging.getLogger()
+    for h in [h for h in root.handlers if isinstance(h, _LogPipelineHandler)]:
+        root.removeHandler(h)
+    _log_pipeline.stop()
+    root.addHandler(logging.StreamHandler(_log_pipeline.stream))
+    root.handlers[-1].setFormatter(_log_pipeline.formatter)
+    _log_pipeline = None
+
+
+def _flush_logs():
+    """
+    Waits for queued log records to be written. Used before a child process writes to the same terminal.
+    """
+    if _log_pipeline is not None:
+        _log_pipeline.flush(_current_task.get())
+
 
 @runtime_checkable
 class ExecProtocol(Protocol):
@@ -203,6 +545,322 @@ class SystemContext(NamedTuple):
     distro: str  # Debian, Arch, RHEL
 
 
+class CapturedOutput(object):
+    """
+    Output captured by exec(capture_limit=...). Held in memory until it grows past limit bytes,
+    after which it is spilled to a temp file that is removed by close() or garbage collection.
+
+    Args:
+    - limit (int): Number of bytes held in memory before spilling to disk.
+    - tail_lines (int, optional): Number of trailing lines kept in tail. Defaults to 100.
+    """
+
+    # longest partial line held for tail. anything before it is dropped
+    MAX_LINE = 64 * 1024
+
+    def __init__(self, limit: int, tail_lines: int = 100):
+        self.limit = limit
+        self.size = 0
+        self.path: str = None
+        self._buf = bytearray()
+        self._file = None
+        self._finalizer = None
+        self._tail = collections.deque(maxlen=tail_lines)
+        self._partial = b""
+
+    @property
+    def spilled(self) -> bool:
+        return self.path is not None
+
+    @property
+    def tail(self) -> List[str]:
+        """
+        The last lines of output, decoded.
+        """
+        lines = list(self._tail)
+        if self._partial:
+            lines = (lines + [self._partial])[-self._tail.maxlen :]
+        encoding = locale.getpreferredencoding(False)
+        return [line.decode(encoding, errors="replace") for line in lines]
+
+    def write(self, data: bytes):
+        self.size += len(data)
+        if self._file is None and len(self._buf) + len(data) > self.limit:
+            fd, self.path = tempfile.mkstemp(prefix="task-capture-")
+            self._file = os.fdopen(fd, "w+b")
+            self._finalizer = weakref.finalize(self, _remove_captured_file, self._file, self.path)
+            self._file.write(self._buf)
+            self._buf = None
+        if self._file is not None:
+            self._file.write(data)
+        else:
+            self._buf.extend(data)
+
+        lines = (self._partial + data).split(b"\n")
+        self._partial = lines.pop()[-self.MAX_LINE :]
+        self._tail.extend(lines)
+
+    def finish(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def read(self) -> bytes:
+        """
+        Returns all of the output. Prefer mmap() or path for output that was spilled.
+        """
+        if self._file is None:
+            return bytes(self._buf)
+        self._file.seek(0)
+        return self._file.read()
+
+    def text(self, encoding: str = None) -> str:
+        return self.read().decode(encoding or locale.getpreferredencoding(False))
+
+    def mmap(self):
+        """
+        Returns a read only buffer over the output without copying it.
+        """
+        if self._file is None:
+            return memoryview(self._buf).toreadonly()
+        if self.size == 0:
+            return memoryview(b"")
+        return mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self._finalizer is not None:
+            self._finalizer()
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        where = self.path if self.spilled else "memory"
+        return f"CapturedOutput(size={self.size}, {where})"
+
+
+def _remove_captured_file(f, path: str):
+    f.close()
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _drain(f, write: Callable[[bytes], None]):
+    with f:
+        while True:
+            chunk = f.read1(65536)
+            if not chunk:
+                break
+            write(chunk)
+
+
+# returncode reported for commands and tasks that ran out of time. same as coreutils timeout
+TIMEOUT_RETURNCODE = 124
+
+# seconds between SIGTERM and SIGKILL when tearing down a process group
+KILL_GRACE = 5.0
+
+
+class ResourceUsage(NamedTuple):
+    wall_time: float  # seconds from start until the process was reaped
+    user_time: float  # cpu seconds in user mode
+    system_time: float  # cpu seconds in kernel mode
+    max_rss: int  # peak resident set size in bytes
+
+    @staticmethod
+    def from_rusage(wall_time: float, rusage) -> "ResourceUsage":
+        # linux reports kilobytes, macos bytes
+        scale = 1 if sys.platform == "darwin" else 1024
+        return ResourceUsage(wall_time, rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss * scale)
+
+
+class ExecResult(CompletedProcess):
+    """
+    CompletedProcess returned by exec(). timed_out is set when the command was killed for running past its timeout.
+    usage holds the wall time, cpu time and peak memory of the child, or None where wait4() isn't available.
+    """
+
+    def __init__(
+        self, args, returncode, stdout=None, stderr=None, timed_out: bool = False, usage: ResourceUsage = None
+    ):
+        super().__init__(args=args, returncode=returncode, stdout=stdout, stderr=stderr)
+        self.timed_out = timed_out
+        self.usage = usage
+
+
+def _new_process_group() -> Dict[str, Any]:
+    """
+    Popen arguments that start the child in its own process group so it can be torn down with its children.
+    """
+    if os.name == "nt":
+        return {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+    if sys.version_info >= (3, 11):
+        return {"process_group": 0}
+    return {"preexec_fn": os.setpgrp}
+
+
+def _signal_process_group(proc: subprocess.Popen, sig: int):
+    try:
+        if os.name != "nt":
+            os.killpg(proc.pid, sig)
+        elif sig == signal.SIGTERM:
+            proc.terminate()
+        else:
+            proc.kill()
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def _wait_process(proc: subprocess.Popen, timeout: float = None):
+    """
+    Reaps proc with wait4() so that its resource usage is collected. Returns the rusage, or None if
+    it isn't available on this platform. Raises subprocess.TimeoutExpired like Popen.wait().
+    """
+    if not hasattr(os, "wait4"):
+        proc.wait(timeout=timeout)
+        return None
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    delay = 0.0005
+    while True:
+        try:
+            pid, status, rusage = os.wait4(proc.pid, 0 if deadline is None else os.WNOHANG)
+        except ChildProcessError:
+            # already reaped elsewhere
+            proc.wait()
+            return None
+        if pid != 0:
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            return rusage
+        # same backoff Popen.wait() uses when given a timeout
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise subprocess.TimeoutExpired(proc.args, timeout)
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 0.05)
+
+
+def _terminate_process_group(proc: subprocess.Popen, grace: float = None):
+    """
+    Sends SIGTERM to the process group of proc, waits up to grace seconds for proc to exit and then
+    sends SIGKILL to whatever is left in the group. Returns the rusage of proc like _wait_process().
+    """
+    _signal_process_group(proc, signal.SIGTERM)
+    rusage = None
+    try:
+        rusage = _wait_process(proc, KILL_GRACE if grace is None else grace)
+    except subprocess.TimeoutExpired:
+        pass
+    _signal_process_group(proc, getattr(signal, "SIGKILL", signal.SIGTERM))
+    if proc.returncode is None:
+        rusage = _wait_process(proc)
+    return rusage
+
+
+def _remaining(timeout: float, deadline: float) -> typing.Optional[float]:
+    """
+    Returns the smaller of timeout and the seconds left until deadline (a time.monotonic() value).
+    """
+    if deadline is None:
+        return timeout
+    left = max(0.0, deadline - time.monotonic())
+    return left if timeout is None else min(timeout, left)
+
+
+def _decode_output(data: bytes) -> str:
+    # same decoding as Popen(text=True)
+    text = data.decode(locale.getpreferredencoding(False))
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+def _run_process(args, cwd, input, env, capture, text, timeout, capture_limit=None, tail_lines=100) -> ExecResult:
+    """
+    Runs args to completion. Output is read and input written on background threads so that the
+    main thread can reap the child with wait4() and collect its resource usage.
+    """
+    grouped = timeout is not None
+    start = time.monotonic()
+    proc = subprocess.Popen(
+        args,
+        cwd=cwd,
+        env=env,
+        stdin=subprocess.PIPE if input is not None else None,
+        stdout=subprocess.PIPE if capture else None,
+        stderr=subprocess.PIPE if capture else None,
+        **(_new_process_group() if grouped else {}),
+    )
+
+    out = err = None
+    threads = []
+    if capture and capture_limit is not None:
+        out = CapturedOutput(capture_limit, tail_lines)
+        err = CapturedOutput(capture_limit, tail_lines)
+        threads.append(threading.Thread(target=_drain, args=(proc.stdout, out.write), daemon=True))
+        threads.append(threading.Thread(target=_drain, args=(proc.stderr, err.write), daemon=True))
+    elif capture:
+        out, err = [], []
+        threads.append(threading.Thread(target=_drain, args=(proc.stdout, out.append), daemon=True))
+        threads.append(threading.Thread(target=_drain, args=(proc.stderr, err.append), daemon=True))
+    if input is not None:
+        data = input.encode(locale.getpreferredencoding(False)) if isinstance(input, str) else input
+        threads.append(threading.Thread(target=_write_pipe_input, args=(proc.stdin, data), daemon=True))
+    for t in threads:
+        t.start()
+
+    timed_out = False
+    try:
+        rusage = _wait_process(proc, timeout)
+    except subprocess.TimeoutExpired:
+        timed_out = True
+        rusage = _terminate_process_group(proc)
+    except BaseException:
+        # in its own group the child never saw the Ctrl-C
+        if grouped:
+            _terminate_process_group(proc)
+        else:
+            proc.kill()
+            proc.wait()
+        raise
+    wall_time = time.monotonic() - start
+    for t in threads:
+        t.join()
+
+    if isinstance(out, CapturedOutput):
+        out.finish()
+        err.finish()
+    elif capture:
+        out, err = b"".join(out), b"".join(err)
+        if text:
+            out, err = _decode_output(out), _decode_output(err)
+
+    return ExecResult(
+        args=args,
+        returncode=TIMEOUT_RETURNCODE if timed_out else proc.returncode,
+        stdout=out,
+        stderr=err,
+        timed_out=timed_out,
+        usage=ResourceUsage.from_rusage(wall_time, rusage) if rusage is not None else None,
+    )
+
+
+def _failed_output(message: str, capture: bool, capture_limit: int, tail_lines: int) -> typing.Tuple[Any, Any]:
+    """
+    stdout and stderr for a command that didn't get to run. message goes to stderr. Output is
+    CapturedOutput like a command that ran would have returned when capture_limit is set.
+    """
+    if not capture or capture_limit is None:
+        return "", message
+    out = CapturedOutput(capture_limit, tail_lines)
+    err = CapturedOutput(capture_limit, tail_lines)
+    err.write(message.encode(locale.getpreferredencoding(False)))
+    return out, err
+
+
+def _split_cmd(cmd) -> List[str]:
+    return cmd if isinstance(cmd, list) else [arg.strip() for arg in shlex.split(cmd.strip())]
+
+
 def exec(
     cmd: str,
     cwd: str = None,
@@ -212,35 +870,565 @@ def exec(
     input: str = None,
     env: Dict[str, str] = None,
     text: bool = True,
-) -> CompletedProcess[str]:
-    args = (
-        cmd
-        if isinstance(cmd, list)
-        else [arg.strip() for arg in shlex.split(cmd.strip())]
-    )
+    capture_limit: int = None,
+    tail_lines: int = 100,
+    timeout: float = None,
+) -> ExecResult:
+    args = _split_cmd(cmd)
     if isinstance(logger, Logger) and not capture:
         if cwd:
             logger.debug("Executing: [%s] Cwd: [%s]", " ".join(args), cwd)
         else:
             logger.debug("Executing: [%s]", " ".join(args))
+    if not capture:
+        _flush_logs()
 
     try:
         if env:
             env = {**os.environ.copy(), **env}
 
-        return subprocess.run(
-            args,
-            check=False,
-            text=text,
+        if timeout is not None and timeout <= 0:
+            output = _failed_output("", capture, capture_limit, tail_lines)
+            result = ExecResult(args, TIMEOUT_RETURNCODE, *output, timed_out=True)
+        else:
+            result = _run_process(args, cwd, input, env, capture, text, timeout, capture_limit, tail_lines)
+    except Exception as ex:
+        if isinstance(logger, Logger):
+            logger.exception("Error executing: [%s]", " ".join(args))
+        output = _failed_output(str(ex), capture, capture_limit, tail_lines)
+        return ExecResult(args, 1, *output)
+
+    if result.timed_out and isinstance(logger, Logger):
+        logger.error("Timed out after %ss: [%s]", round(timeout, 3), " ".join(args))
+    return result
+
+
+async def _aterminate(proc: asyncio.subprocess.Process, grouped: bool):
+    if not grouped:
+        proc.kill()
+        await proc.wait()
+        return
+    _signal_process_group(proc, signal.SIGTERM)
+    try:
+        await asyncio.wait_for(proc.wait(), KILL_GRACE)
+    except asyncio.TimeoutError:
+        pass
+    _signal_process_group(proc, getattr(signal, "SIGKILL", signal.SIGTERM))
+    await proc.wait()
+
+
+async def aexec(
+    cmd: str,
+    cwd: str = None,
+    logger: Logger = None,
+    capture: bool = False,
+    input: str = None,
+    env: Dict[str, str] = None,
+    text: bool = True,
+    timeout: float = None,
+) -> ExecResult:
+    """
+    exec() for async tasks. The command is killed if the awaiting task is cancelled.
+    usage is not collected since the event loop reaps the child.
+    """
+    args = _split_cmd(cmd)
+    if isinstance(logger, Logger) and not capture:
+        if cwd:
+            logger.debug("Executing: [%s] Cwd: [%s]", " ".join(args), cwd)
+        else:
+            logger.debug("Executing: [%s]", " ".join(args))
+    if not capture:
+        _flush_logs()
+
+    if env:
+        env = {**os.environ.copy(), **env}
+    if timeout is not None and timeout <= 0:
+        return ExecResult(args, TIMEOUT_RETURNCODE, "", "", timed_out=True)
+
+    grouped = timeout is not None
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *args,
             cwd=cwd,
-            capture_output=capture,
-            input=input,
             env=env,
+            stdin=subprocess.PIPE if input is not None else None,
+            stdout=subprocess.PIPE if capture else None,
+            stderr=subprocess.PIPE if capture else None,
+            **(_new_process_group() if grouped else {}),
         )
     except Exception as ex:
         if isinstance(logger, Logger):
             logger.exception("Error executing: [%s]", " ".join(args))
-        return CompletedProcess(args=args, returncode=1, stdout="", stderr=str(ex))
+        return ExecResult(args=args, returncode=1, stdout="", stderr=str(ex))
+
+    data = input.encode(locale.getpreferredencoding(False)) if isinstance(input, str) else input
+    try:
+        out, err = await asyncio.wait_for(proc.communicate(data), timeout)
+    except asyncio.TimeoutError:
+        await _aterminate(proc, grouped)
+        if isinstance(logger, Logger):
+            logger.error("Timed out after %ss: [%s]", round(timeout, 3), " ".join(args))
+        empty = ("", "") if text else (b"", b"")
+        return ExecResult(args, TIMEOUT_RETURNCODE, *(empty if capture else (None, None)), timed_out=True)
+    except BaseException:
+        if proc.returncode is None:
+            await _aterminate(proc, grouped)
+        raise
+
+    if capture and text:
+        out, err = _decode_output(out), _decode_output(err)
+    return ExecResult(args=args, returncode=proc.returncode, stdout=out, stderr=err)
+
+
+def _write_pipe_input(f, data: bytes):
+    try:
+        f.write(data)
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            f.close()
+        except BrokenPipeError:
+            pass
+
+
+class PipelineProcess(CompletedProcess):
+    """
+    Result of pipe(). returncodes holds the code of each stage. returncode is the last non-zero
+    stage code, or 0 if every stage succeeded, which matches `set -o pipefail` in bash.
+    timed_out is set when the pipeline was killed for running past its timeout.
+    """
+
+    def __init__(self, args, returncodes: List[int], stdout=None, stderr=None, timed_out: bool = False):
+        returncode = next((rc for rc in reversed(returncodes) if rc != 0), 0)
+        super().__init__(args=args, returncode=returncode, stdout=stdout, stderr=stderr)
+        self.returncodes = returncodes
+        self.timed_out = timed_out
+
+
+def _terminate_pipeline(procs: List[subprocess.Popen]):
+    """
+    Tears down the process group of every stage still running. Stages get KILL_GRACE seconds between
+    SIGTERM and SIGKILL in total rather than each.
+    """
+    running = [proc for proc in procs if proc.poll() is None]
+    for proc in running:
+        _signal_process_group(proc, signal.SIGTERM)
+    deadline = time.monotonic() + KILL_GRACE
+    for proc in running:
+        try:
+            proc.wait(timeout=_remaining(None, deadline))
+        except subprocess.TimeoutExpired:
+            pass
+    for proc in running:
+        _signal_process_group(proc, getattr(signal, "SIGKILL", signal.SIGTERM))
+        proc.wait()
+
+
+def pipe(
+    cmds: List[str],
+    cwd: str = None,
+    logger: Logger = None,
+    capture: bool = False,
+    input: str = None,
+    stdin: str = None,
+    stdout: str = None,
+    append: bool = False,
+    env: Dict[str, str] = None,
+    text: bool = True,
+    timeout: float = None,
+) -> PipelineProcess:
+    """
+    Runs cmds connected stdout to stdin with OS pipes, like `cmd1 | cmd2 | cmd3` in a shell.
+
+    Args:
+    - cmds (list): Commands to run. Each one is a string or a list like exec() accepts.
+    - cwd (str, optional): Working directory for every stage.
+    - logger (Logger, optional): Logs the pipeline being executed and any errors.
+    - capture (bool, optional): Capture stdout of the last stage and stderr of every stage.
+    - input (str, optional): Data written to stdin of the first stage.
+    - stdin (str, optional): File that stdin of the first stage is read from.
+    - stdout (str, optional): File that stdout of the last stage is written to.
+    - append (bool, optional): Append to stdout instead of truncating it. Defaults to False.
+    - env (dict, optional): Extra environment variables for every stage.
+    - text (bool, optional): input, stdout and stderr are str instead of bytes. Defaults to True.
+    - timeout (float, optional): Seconds the pipeline may run. Stages still running are killed with their
+      process groups and report TIMEOUT_RETURNCODE.
+
+    Returns:
+    PipelineProcess
+    """
+    if not cmds:
+        raise ValueError("pipe requires at least one command")
+    if input is not None and stdin is not None:
+        raise ValueError("input and stdin are mutually exclusive")
+
+    stages = [_split_cmd(cmd) for cmd in cmds]
+    display = " | ".join(" ".join(args) for args in stages)
+    if stdin:
+        display = f"{display} < {stdin}"
+    if stdout:
+        display = f"{display} {'>>' if append else '>'} {stdout}"
+    if isinstance(logger, Logger) and not capture:
+        if cwd:
+            logger.debug("Executing: [%s] Cwd: [%s]", display, cwd)
+        else:
+            logger.debug("Executing: [%s]", display)
+    if not capture:
+        _flush_logs()
+
+    encoding = locale.getpreferredencoding(False)
+    if env:
+        env = {**os.environ.copy(), **env}
+    if timeout is not None and timeout <= 0:
+        return PipelineProcess(stages, [TIMEOUT_RETURNCODE] * len(stages), "", "", timed_out=True)
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    procs: List[subprocess.Popen] = []
+    files = []
+    try:
+        stdin_file = open(stdin, "rb") if stdin else None
+        files.append(stdin_file)
+        stdout_file = open(stdout, "ab" if append else "wb") if stdout else None
+        files.append(stdout_file)
+        # every stage shares one file for stderr so no stage can block on a full pipe
+        stderr_file = tempfile.TemporaryFile() if capture else None
+        files.append(stderr_file)
+
+        for idx, args in enumerate(stages):
+            first, last = idx == 0, idx == len(stages) - 1
+            if not first:
+                proc_stdin = procs[-1].stdout
+            elif stdin_file:
+                proc_stdin = stdin_file
+            elif input is not None:
+                proc_stdin = subprocess.PIPE
+            else:
+                proc_stdin = None
+
+            if not last:
+                proc_stdout = subprocess.PIPE
+            elif stdout_file:
+                proc_stdout = stdout_file
+            elif capture:
+                proc_stdout = subprocess.PIPE
+            else:
+                proc_stdout = None
+
+            procs.append(
+                subprocess.Popen(
+                    args,
+                    stdin=proc_stdin,
+                    stdout=proc_stdout,
+                    stderr=stderr_file,
+                    cwd=cwd,
+                    env=env,
+                    **(_new_process_group() if deadline is not None else {}),
+                )
+            )
+            if not first:
+                # drop our copy so the upstream stage sees SIGPIPE if this one exits early
+                procs[-2].stdout.close()
+
+        data = input.encode(encoding) if isinstance(input, str) else input
+        writer = None
+        if data is not None and len(procs) > 1:
+            # communicate() only feeds the last stage so the first one gets its own writer
+            writer = threading.Thread(target=_write_pipe_input, args=(procs[0].stdin, data), daemon=True)
+            writer.start()
+            data = None
+
+        timed_out = False
+        out = communicated = None
+        try:
+            out, _ = communicated = procs[-1].communicate(data, timeout=_remaining(None, deadline))
+            for proc in procs:
+                proc.wait(timeout=_remaining(None, deadline))
+        except subprocess.TimeoutExpired:
+            timed_out = True
+            running = [proc.poll() is None for proc in procs]
+            _terminate_pipeline(procs)
+            if communicated is None:
+                # collects what the last stage wrote before it was killed
+                out, _ = procs[-1].communicate()
+        if writer:
+            writer.join()
+        if timed_out:
+            returncodes = [TIMEOUT_RETURNCODE if r else proc.returncode for proc, r in zip(procs, running)]
+            if isinstance(logger, Logger):
+                logger.error("Timed out after %ss: [%s]", round(timeout, 3), display)
+        else:
+            returncodes = [proc.returncode for proc in procs]
+
+        err = None
+        if stderr_file:
+            stderr_file.seek(0)
+            err = stderr_file.read()
+        if text:
+            out = out.decode(encoding) if out is not None else out
+            err = err.decode(encoding) if err is not None else err
+        return PipelineProcess(args=stages, returncodes=returncodes, stdout=out, stderr=err, timed_out=timed_out)
+    except Exception as ex:
+        for proc in procs:
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+        if isinstance(logger, Logger):
+            logger.exception("Error executing: [%s]", display)
+        returncodes = [proc.returncode for proc in procs] + [1] * (len(stages) - len(procs))
+        return PipelineProcess(args=stages, returncodes=returncodes, stdout="", stderr=str(ex))
+    except BaseException:
+        if deadline is not None:
+            # in their own groups the stages never saw the Ctrl-C
+            _terminate_pipeline(procs)
+        raise
+    finally:
+        for f in files:
+            if f:
+                f.close()
+
+
+class ShellSession(object):
+    """
+    A long lived bash process. Commands are written to its stdin and each one is followed by a
+    marker on stdout and stderr so that its output and exit code can be picked apart.
+
+    State carries over between commands, e.g. `cd` or `export`. Commands read stdin from /dev/null.
+    The shell runs in its own process group so that a command that times out can be killed along with
+    its children. That ends the session.
+
+    Args:
+    - cwd (str, optional): Working directory the shell starts in.
+    - env (dict, optional): Extra environment variables for the shell.
+    - logger (Logger, optional): Logs commands being executed.
+    - shell (str, optional): Shell executable. Defaults to bash.
+    - deadline (float, optional): time.monotonic() by which every command has to finish.
+    """
+
+    def __init__(
+        self,
+        cwd: str = None,
+        env: Dict[str, str] = None,
+        logger: Logger = None,
+        shell: str = "bash",
+        deadline: float = None,
+    ):
+        if env:
+            env = {**os.environ.copy(), **env}
+        self.logger = logger
+        self.deadline = deadline
+        self.returncode = None
+        self._marker = f"__task_{uuid.uuid4().hex}__".encode()
+        self._lock = threading.Lock()
+        self._proc = subprocess.Popen(
+            [shell, "--noprofile", "--norc"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=cwd,
+            env=env,
+            **_new_process_group(),
+        )
+        # (stream, chunk) from both readers, 0 for stdout and 1 for stderr. chunk is None at eof
+        self._chunks = queue.SimpleQueue()
+        self._readers = [
+            threading.Thread(target=self._read, args=(self._proc.stdout, 0, self._chunks), daemon=True),
+            threading.Thread(target=self._read, args=(self._proc.stderr, 1, self._chunks), daemon=True),
+        ]
+        for reader in self._readers:
+            reader.start()
+
+    @staticmethod
+    def _read(f, stream: int, chunks: queue.SimpleQueue):
+        while True:
+            chunk = os.read(f.fileno(), 65536)
+            if not chunk:
+                chunks.put((stream, None))
+                return
+            chunks.put((stream, chunk))
+
+    @property
+    def closed(self) -> bool:
+        return self.returncode is not None
+
+    def _collect(self, forwards, deadline: float = None) -> List[typing.Tuple[bytes, bytes]]:
+        """
+        Reads stdout and stderr as they arrive until the marker shows up on both. Output is passed to
+        forwards[stream] as it is read unless that is None. Returns (output, rest of the marker line)
+        for each stream, or (output, None) for a stream that closed first because the shell exited.
+        Raises subprocess.TimeoutExpired with the output read so far at deadline.
+        """
+        bufs = [bytearray(), bytearray()]
+        sent = [0, 0]
+        results = [None, None]
+        while None in results:
+            try:
+                stream, chunk = self._chunks.get(timeout=_remaining(None, deadline))
+            except queue.Empty:
+                for forward, buf, start in zip(forwards, bufs, sent):
+                    if forward:
+                        forward(bytes(buf[start:]))
+                raise subprocess.TimeoutExpired(None, None, output=bytes(bufs[0]), stderr=bytes(bufs[1]))
+
+            buf, forward = bufs[stream], forwards[stream]
+            if chunk is None:
+                if forward:
+                    forward(bytes(buf[sent[stream] :]))
+                results[stream] = (bytes(buf), None)
+                continue
+            buf.extend(chunk)
+
+            idx = buf.find(self._marker)
+            if idx >= 0:
+                end = buf.find(b"\n", idx)
+                if end >= 0:
+                    if forward:
+                        forward(bytes(buf[sent[stream] : idx]))
+                    results[stream] = (bytes(buf[:idx]), bytes(buf[idx + len(self._marker) : end]))
+            elif forward:
+                safe = self._partial_marker(buf, sent[stream])
+                if safe > sent[stream]:
+                    forward(bytes(buf[sent[stream] : safe]))
+                    sent[stream] = safe
+        return results
+
+    def _partial_marker(self, buf: bytearray, start: int) -> int:
+        """
+        Returns where a marker split across reads may begin in buf, or len(buf) if it can't end with one.
+        Output before it is safe to forward.
+        """
+        pos = buf.find(self._marker[:1], max(start, len(buf) - len(self._marker) + 1))
+        while pos >= 0:
+            if self._marker.startswith(buf[pos:]):
+                return pos
+            pos = buf.find(self._marker[:1], pos + 1)
+        return len(buf)
+
+    def run(self, cmd: str, capture: bool = False, text: bool = True, timeout: float = None) -> ExecResult:
+        """
+        Runs cmd in the session.
+
+        Args:
+        - cmd (str): Shell command. Lists are quoted and joined.
+        - capture (bool, optional): Capture stdout and stderr instead of passing them through. Defaults to False.
+        - text (bool, optional): stdout and stderr are str instead of bytes. Defaults to True.
+        - timeout (float, optional): Seconds cmd may run. The session is killed if it runs longer and the
+          result has TIMEOUT_RETURNCODE and timed_out set.
+
+        Returns:
+        ExecResult
+        """
+        if isinstance(cmd, list):
+            cmd = shlex.join(cmd)
+        with self._lock:
+            if self.closed:
+                raise RuntimeError("shell session is closed")
+
+            if isinstance(self.logger, Logger) and not capture:
+                self.logger.debug("Executing: [%s]", cmd)
+            if not capture:
+                _flush_logs()
+
+            timeout = _remaining(timeout, self.deadline)
+            deadline = None if timeout is None else time.monotonic() + timeout
+            marker = self._marker.decode()
+            script = (
+                f"eval {shlex.quote(cmd)} < /dev/null\n"
+                f"printf '%s %d\\n' {marker} $?\n"
+                f"printf '%s\\n' {marker} >&2\n"
+            )
+            try:
+                self._proc.stdin.write(script.encode())
+                self._proc.stdin.flush()
+            except BrokenPipeError:
+                pass
+
+            timed_out = False
+            forwards = (None, None) if capture else (_forward_to(sys.stdout), _forward_to(sys.stderr))
+            try:
+                (out, status), (err, _) = self._collect(forwards, deadline)
+            except subprocess.TimeoutExpired as ex:
+                timed_out = True
+                out, err = ex.output, ex.stderr
+                self._kill()
+                if isinstance(self.logger, Logger):
+                    self.logger.error("Timed out after %ss: [%s]", round(timeout, 3), cmd)
+            except BaseException:
+                # in its own group the command never saw the Ctrl-C
+                self._kill()
+                raise
+
+            if timed_out:
+                returncode = TIMEOUT_RETURNCODE
+            elif status is None:
+                # the command exited the shell
+                self.returncode = self._proc.wait()
+                returncode = self.returncode
+            else:
+                returncode = int(status.strip() or 1)
+
+        if not capture:
+            out = err = None
+        elif text:
+            encoding = locale.getpreferredencoding(False)
+            out, err = out.decode(encoding), err.decode(encoding)
+        return ExecResult(args=cmd, returncode=returncode, stdout=out, stderr=err, timed_out=timed_out)
+
+    def _kill(self):
+        self.returncode = self._proc.returncode
+        if self.returncode is None:
+            _terminate_process_group(self._proc)
+            self.returncode = self._proc.returncode
+
+    def close(self):
+        with self._lock:
+            if not self.closed:
+                try:
+                    self._proc.stdin.write(b"exit\n")
+                    self._proc.stdin.flush()
+                except (BrokenPipeError, ValueError):
+                    pass
+            try:
+                # the fd is closed even when flushing what a killed shell never read fails
+                self._proc.stdin.close()
+            except (BrokenPipeError, ValueError):
+                pass
+            if not self.closed:
+                try:
+                    self.returncode = self._proc.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    self._kill()
+            for reader in self._readers:
+                reader.join()
+            self._proc.stdout.close()
+            self._proc.stderr.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _forward_to(stream):
+    buffer = getattr(stream, "buffer", None)
+    if buffer is None:
+        # a text only stream like StringIO. incremental so characters split across reads decode whole
+        encoding = getattr(stream, "encoding", None) or locale.getpreferredencoding(False)
+        decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+
+    def _forward(data: bytes):
+        if not data:
+            return
+        if buffer is None:
+            stream.write(decoder.decode(data))
+            stream.flush()
+            return
+        stream.flush()
+        buffer.write(data)
+        buffer.flush()
+
+    return _forward
 
 
 @dataclass
@@ -250,6 +1438,13 @@ class TaskContext(ExecProtocol):
     log: Logger
     system: SystemContext
     args: Dict[str, Any] = field(default_factory=dict)
+    # time.monotonic() by which the task has to finish. set from add_task(timeout=...)
+    deadline: float = None
+    _sessions: List[ShellSession] = field(default_factory=list, init=False, repr=False)
+    # number of processes started through this context
+    _subprocesses: int = field(default=0, init=False, repr=False)
+    # resource usage of each exec() made through this context
+    _usage: List[ResourceUsage] = field(default_factory=list, init=False, repr=False)
 
     def exec(
         self,
@@ -260,8 +1455,12 @@ class TaskContext(ExecProtocol):
         input: str = None,
         env: Dict[str, str] = None,
         text: bool = True,
-    ) -> CompletedProcess[str]:
-        return exec(
+        capture_limit: int = None,
+        tail_lines: int = 100,
+        timeout: float = None,
+    ) -> ExecResult:
+        self._subprocesses += 1
+        result = exec(
             cmd=cmd,
             cwd=cwd,
             logger=self.log,
@@ -270,8 +1469,82 @@ class TaskContext(ExecProtocol):
             input=input,
             env=env,
             text=text,
+            capture_limit=capture_limit,
+            tail_lines=tail_lines,
+            timeout=_remaining(timeout, self.deadline),
+        )
+        if result.usage is not None:
+            self._usage.append(result.usage)
+            if _run_metrics is not None:
+                _run_metrics.add_exec(_current_task.get(), result.args, result.usage)
+        return result
+
+    async def aexec(
+        self,
+        cmd: str,
+        cwd: str = None,
+        capture: bool = False,
+        input: str = None,
+        env: Dict[str, str] = None,
+        text: bool = True,
+        timeout: float = None,
+    ) -> ExecResult:
+        self._subprocesses += 1
+        return await aexec(
+            cmd=cmd,
+            cwd=cwd,
+            logger=self.log,
+            capture=capture,
+            input=input,
+            env=env,
+            text=text,
+            timeout=_remaining(timeout, self.deadline),
         )
 
+    def pipe(
+        self,
+        cmds: List[str],
+        cwd: str = None,
+        capture: bool = False,
+        input: str = None,
+        stdin: str = None,
+        stdout: str = None,
+        append: bool = False,
+        env: Dict[str, str] = None,
+        text: bool = True,
+        timeout: float = None,
+    ) -> PipelineProcess:
+        self._subprocesses += len(cmds)
+        return pipe(
+            cmds=cmds,
+            cwd=cwd,
+            logger=self.log,
+            capture=capture,
+            input=input,
+            stdin=stdin,
+            stdout=stdout,
+            append=append,
+            env=env,
+            text=text,
+            timeout=_remaining(timeout, self.deadline),
+        )
+
+    def shell(self, cwd: str = None, env: Dict[str, str] = None) -> ShellSession:
+        """
+        Starts a ShellSession that is closed when the task finishes.
+        """
+        session = ShellSession(cwd=cwd, env=env, logger=self.log, deadline=self.deadline)
+        self._subprocesses += 1
+        self._sessions.append(session)
+        return session
+
+    def close(self):
+        """
+        Releases anything the task left open.
+        """
+        while self._sessions:
+            self._sessions.pop().close()
+
 
 class TaskFileDefinition(NamedTuple):
     func: Callable[[TaskContext], None]  # configure func
@@ -286,6 +1559,11 @@ class TaskDefinition(NamedTuple):
     filename: str
     dir: str
     deps: List[str] = []
+    matrix: Dict[str, List[Any]] = {}
+    timeout: float = None
+    inputs: List[str] = None  # globs relative to dir. the task is cached when set
+    outputs: List[str] = []  # globs relative to dir, restored on a cache hit
+    env: List[str] = []  # env vars that are part of the cache key
 
 
 class TaskBuilder(object):
@@ -297,7 +1575,16 @@ class TaskBuilder(object):
         self.python_exe = python_exe
 
     def add_task(
-        self, module: str, name: str, func: callable, deps: List[str] = []
+        self,
+        module: str,
+        name: str,
+        func: callable,
+        deps: List[str] = [],
+        matrix: Dict[str, List[Any]] = None,
+        timeout: float = None,
+        inputs: List[str] = None,
+        outputs: List[str] = None,
+        env: List[str] = None,
     ) -> None:
         """
         Add a task to the list of parsers.
@@ -307,10 +1594,24 @@ class TaskBuilder(object):
         - name (str): The name of the task.
         - func (callable): The function that implements the task.
         - deps (list[str]): A list of task names that this task depends on.
+        - matrix (dict, optional): Argument names mapped to the values to run the task with. The task
+          runs once per combination. Arguments given on the command line replace an axis.
+        - timeout (float, optional): Seconds the task may run. Commands started through the context (exec,
+          aexec, pipe and shell) that are still running are killed and the task fails with TIMEOUT_RETURNCODE.
+        - inputs (list[str], optional): Globs of files the task reads, relative to the task file. Declaring
+          inputs makes the task cacheable, see --cache-url.
+        - outputs (list[str], optional): Globs of files and directories the task produces. Stored in and
+          restored from the cache.
+        - env (list[str], optional): Names of environment variables that change what the task does.
         """
         if not isinstance(deps, list):
             raise TypeError(f"deps must be a list, got {type(deps)}")
-        self.parsers.append((module, name, func, deps))
+        if matrix is not None and not all(isinstance(v, list) for v in matrix.values()):
+            raise TypeError("matrix values must be lists")
+        for arg_name, arg in (("inputs", inputs), ("outputs", outputs), ("env", env)):
+            if arg is not None and not isinstance(arg, list):
+                raise TypeError(f"{arg_name} must be a list, got {type(arg)}")
+        self.parsers.append((module, name, func, deps, matrix or {}, timeout, inputs, outputs or [], env or []))
 
 
 def _ensure_venv(ctx: TaskContext):
@@ -326,7 +1627,7 @@ def _load_tasks(task: TaskFileDefinition) -> typing.Dict[str, TaskDefinition]:
     tasks: typing.Dict[str, TaskDefinition] = {}
     builder = TaskBuilder()
     task.func(builder)
-    for module, name, func, deps in builder.parsers:
+    for module, name, func, deps, matrix, timeout, inputs, outputs, env in builder.parsers:
         tasks[name] = TaskDefinition(
             module=module,
             name=name,
@@ -334,6 +1635,11 @@ def _load_tasks(task: TaskFileDefinition) -> typing.Dict[str, TaskDefinition]:
             dir=task.dir,
             filename=task.filename,
             deps=deps,
+            matrix=matrix,
+            timeout=timeout,
+            inputs=inputs,
+            outputs=outputs,
+            env=env,
         )
     return tasks
 
@@ -450,6 +1756,12 @@ arguments:
 options:
   -h, --help  show this help message and exit
   -v, --verbose  enabled debug logging
+  -q, --quiet  disable logging
+  -j, --jobs N  max number of matrix task instances to run at once
+  --metrics PATH  write run metrics to PATH (.prom/.txt for OpenMetrics, otherwise JSON lines)
+  --cache-url URL  share results of tasks that declare inputs through a remote cache
+  --workers HOST:PORT,...  run tasks on workers started with `task worker`
+  --listen HOST:PORT  address for `task worker` to listen on (default 127.0.0.1:7070)
 """
     )
 
@@ -489,6 +1801,7 @@ def _resolve_deps(tasks_to_resolve, tasks):
 def _parse_task_args(task_args: str) -> Dict[str, Any]:
     """
     Parse task arguments from a string in the format name[arg1=val1,arg2=val2,...].
+    Values separated by `|`, like name[arg1=a|b], are returned as a list and form a matrix axis.
 
     Args:
     - task_args (str): The string containing the task arguments.
@@ -502,13 +1815,1019 @@ def _parse_task_args(task_args: str) -> Dict[str, Any]:
         if len(arg) > 0:
             if "=" in arg:
                 key, value = arg.split("=")
-                args[key.strip()] = value.strip()
+                if "|" in value:
+                    args[key.strip()] = [v.strip() for v in value.split("|")]
+                else:
+                    args[key.strip()] = value.strip()
             else:
                 args[arg.strip()] = None
 
     return args
 
 
+def _expand_task_matrix(args: Dict[str, Any], matrix: Dict[str, List[Any]] = None) -> List[Dict[str, Any]]:
+    """
+    Expands list valued arguments and a task's declared matrix into one set of arguments per combination.
+
+    Args:
+    - args (dict): Arguments from _parse_task_args.
+    - matrix (dict, optional): Matrix declared with add_task(). Axes are replaced by arguments of the same name.
+
+    Returns:
+    A list of argument dictionaries. Contains just args when there is nothing to expand.
+    """
+    axes = dict(matrix or {})
+    fixed = {}
+    for k, v in args.items():
+        if isinstance(v, list):
+            axes[k] = v
+        else:
+            fixed[k] = v
+            axes.pop(k, None)
+
+    return [{**fixed, **dict(zip(axes.keys(), values))} for values in itertools.product(*axes.values())]
+
+
+def _format_task_instance(task_name: str, args: Dict[str, Any]) -> str:
+    formatted = ",".join(k if v is None else f"{k}={v}" for k, v in args.items())
+    return f"{task_name}[{formatted}]"
+
+
+class TaskMetrics(NamedTuple):
+    name: str  # task instance, e.g. test[py=3.9]
+    task: str
+    duration: float  # seconds
+    exit_code: int
+    status: str  # ok, failed, timeout, cancelled, skipped, cached
+    subprocesses: int
+    cpu_user: float = 0.0  # seconds, summed over exec() calls
+    cpu_system: float = 0.0
+    max_rss: int = 0  # bytes, largest of any exec() call
+
+
+class ExecMetrics(NamedTuple):
+    task: str
+    args: List[str]
+    usage: ResourceUsage
+
+
+class RunMetrics(object):
+    """
+    Collects timings for a single invocation of the runner and writes them out for scraping.
+    """
+
+    PHASES = ("discovery", "load", "configure", "resolve")
+
+    def __init__(self):
+        self.run_id = uuid.uuid4().hex
+        self.started = time.time()
+        self.phases: Dict[str, float] = {}
+        self.tasks: List[TaskMetrics] = []
+        self.execs: List[ExecMetrics] = []
+        self.exit_code = 0
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.monotonic() - start
+
+    def add_task(self, metrics: TaskMetrics):
+        with self._lock:
+            self.tasks.append(metrics)
+
+    def add_exec(self, task: str, args: List[str], usage: ResourceUsage):
+        with self._lock:
+            self.execs.append(ExecMetrics(task, args, usage))
+
+    def usage_summary(self, top: int = 10) -> str:
+        """
+        Formats the top commands by wall time, cpu time and peak rss.
+        """
+        rankings = [
+            ("wall time", lambda e: e.usage.wall_time),
+            ("cpu time", lambda e: e.usage.user_time + e.usage.system_time),
+            ("peak rss", lambda e: e.usage.max_rss),
+        ]
+        lines = []
+        for title, key in rankings:
+            lines.append(f"Top {min(top, len(self.execs))} commands by {title}:")
+            lines.append(f"  {'wall':>9} {'user':>9} {'sys':>9} {'rss':>9}  task: command")
+            for e in sorted(self.execs, key=key, reverse=True)[:top]:
+                u = e.usage
+                cmd = " ".join(e.args) if isinstance(e.args, list) else str(e.args)
+                lines.append(
+                    f"  {u.wall_time:>8.2f}s {u.user_time:>8.2f}s {u.system_time:>8.2f}s "
+                    f"{u.max_rss / 2**20:>8.1f}M  {e.task}: {cmd}"
+                )
+        return "\n".join(lines)
+
+    @property
+    def duration(self) -> float:
+        return time.monotonic() - self._start
+
+    def write(self, path: str):
+        """
+        Writes an OpenMetrics textfile if path ends in .prom or .txt, otherwise appends JSON lines.
+        """
+        dirname = os.path.dirname(os.path.abspath(path))
+        os.makedirs(dirname, exist_ok=True)
+        if path.endswith((".prom", ".txt")):
+            # write then rename so that a scraper never sees a partial file
+            fd, tmp = tempfile.mkstemp(dir=dirname, prefix=".task-metrics-")
+            with os.fdopen(fd, "w") as f:
+                f.write(self.to_openmetrics())
+            os.replace(tmp, path)
+        else:
+            with open(path, "a") as f:
+                f.write(self.to_json_lines())
+
+    def to_json_lines(self) -> str:
+        lines = [
+            {"type": "task", "run_id": self.run_id, "timestamp": self.started, **t._asdict()} for t in self.tasks
+        ]
+        lines.append(
+            {
+                "type": "run",
+                "run_id": self.run_id,
+                "timestamp": self.started,
+                "duration": self.duration,
+                "exit_code": self.exit_code,
+                "phases": self.phases,
+            }
+        )
+        return "".join(json.dumps(line) + "\n" for line in lines)
+
+    def to_openmetrics(self) -> str:
+        def _labels(**labels):
+            escaped = (
+                (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                for k, v in labels.items()
+            )
+            return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+        families = {
+            "task_run_timestamp_seconds": ("Unix time the run started", [("", self.started)]),
+            "task_run_duration_seconds": ("Wall time of the whole run", [("", self.duration)]),
+            "task_run_exit_code": ("Exit code of the runner", [("", self.exit_code)]),
+            "task_phase_duration_seconds": (
+                "Runner overhead by phase",
+                [(_labels(phase=k), v) for k, v in self.phases.items()],
+            ),
+        }
+        per_task = {
+            "task_duration_seconds": ("Wall time of each task", "duration"),
+            "task_exit_code": ("Exit code of each task", "exit_code"),
+            "task_subprocesses": ("Processes started by each task", "subprocesses"),
+            "task_cpu_user_seconds": ("User cpu time of commands run by each task", "cpu_user"),
+            "task_cpu_system_seconds": ("System cpu time of commands run by each task", "cpu_system"),
+            "task_max_rss_bytes": ("Peak rss of any command run by each task", "max_rss"),
+        }
+        for family, (help, attr) in per_task.items():
+            samples = [
+                (_labels(task=t.task, instance=t.name, status=t.status), getattr(t, attr)) for t in self.tasks
+            ]
+            families[family] = (help, samples)
+
+        lines = []
+        for family, (help, samples) in families.items():
+            lines.append(f"# TYPE {family} gauge")
+            lines.append(f"# HELP {family} {help}")
+            lines.extend(f"{family}{labels} {value}" for labels, value in samples)
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+_run_metrics: RunMetrics = None
+
+# bump when the cache key or archive format changes
+CACHE_VERSION = 1
+
+
+def _glob_files(root: str, patterns: List[str]) -> List[str]:
+    """
+    Returns the files and directories matching patterns under root, relative to root and sorted.
+    """
+    found = set()
+    for pattern in patterns:
+        for path in glob.glob(os.path.join(root, pattern), recursive=True):
+            found.add(os.path.relpath(path, root))
+    return sorted(found)
+
+
+def _hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _task_source(func: Callable) -> str:
+    try:
+        return inspect.getsource(func)
+    except (OSError, TypeError):
+        code = getattr(func, "__code__", None)
+        return code.co_code.hex() if code else repr(func)
+
+
+def _cache_key(task: TaskDefinition, args: Dict[str, Any]) -> str:
+    """
+    Hashes everything that determines a cacheable task's result: its name, args, the contents of its
+    inputs, its declared env vars and the source of its function.
+    """
+    inputs = []
+    for path in _glob_files(task.dir, task.inputs or []):
+        full = os.path.join(task.dir, path)
+        if os.path.isfile(full):
+            inputs.append([path.replace(os.sep, "/"), _hash_file(full)])
+    key = {
+        "version": CACHE_VERSION,
+        "task": task.name,
+        "args": args,
+        "env": {name: os.environ.get(name) for name in sorted(task.env)},
+        "inputs": inputs,
+        "source": _task_source(task.func),
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _safe_members(tar: tarfile.TarFile, dest: str):
+    dest = os.path.realpath(dest)
+    for member in tar.getmembers():
+        target = os.path.realpath(os.path.join(dest, member.name))
+        if os.path.commonpath([dest, target]) != dest or member.issym() or member.islnk():
+            raise ValueError(f"refusing to extract {member.name} outside of {dest}")
+        yield member
+
+
+class RemoteCache(object):
+    """
+    Client for an HTTP cache laid out like bazel's remote cache. Action results, a small JSON document
+    with the exit code and archive digest, are stored under /ac/<key>. Output archives are stored under
+    /cas/<sha256 of the archive>.
+
+    Errors never fail a task. The first connection error disables the cache for the rest of the run.
+    Uploads run on daemon threads so that close() can give up on them without holding up exit.
+
+    Args:
+    - url (str): Base url of the cache.
+    - timeout (float, optional): Seconds to wait on each request. Defaults to 10.
+    """
+
+    def __init__(self, url: str, timeout: float = 10.0):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.available = True
+        self._jobs = queue.SimpleQueue()
+        self._pending: List[concurrent.futures.Future] = []
+        # not a ThreadPoolExecutor, its threads are joined at exit however long an upload takes
+        self._workers = [threading.Thread(target=self._work, name=f"task-cache-{i}", daemon=True) for i in range(2)]
+        for worker in self._workers:
+            worker.start()
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            future, args = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(self._upload(*args))
+            except BaseException as ex:
+                future.set_exception(ex)
+
+    def _request(self, method: str, path: str, data=None, headers: Dict[str, str] = None):
+        """
+        Returns the open response, or None for a miss or when the cache is unavailable.
+        """
+        if not self.available:
+            return None
+        request = urllib.request.Request(f"{self.url}/{path}", data=data, method=method, headers=headers or {})
+        try:
+            return urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as ex:
+            if ex.code != 404:
+                logger.warning("Remote cache %s %s failed: %s", method, path, ex)
+            return None
+        except (urllib.error.URLError, OSError) as ex:
+            logger.warning("Remote cache unavailable, running tasks locally: %s", ex)
+            self.available = False
+            return None
+
+    def get(self, key: str, dest: str) -> typing.Optional[int]:
+        """
+        Restores the outputs stored under key into dest. Returns the cached exit code, or None on a miss.
+        """
+        try:
+            response = self._request("GET", f"ac/{key}")
+            if response is None:
+                return None
+            with response:
+                result = json.loads(response.read())
+
+            digest = result.get("archive")
+            if digest:
+                with tempfile.TemporaryFile() as archive:
+                    response = self._request("GET", f"cas/{digest}")
+                    if response is None:
+                        return None
+                    sha = hashlib.sha256()
+                    with response:
+                        for chunk in iter(lambda: response.read(1024 * 1024), b""):
+                            sha.update(chunk)
+                            archive.write(chunk)
+                    if sha.hexdigest() != digest:
+                        logger.warning("Remote cache returned a corrupt archive for %s", key)
+                        return None
+                    archive.seek(0)
+                    with tarfile.open(fileobj=archive, mode="r:gz") as tar:
+                        if hasattr(tarfile, "data_filter"):
+                            tar.extractall(dest, filter="data")
+                        else:
+                            tar.extractall(dest, members=_safe_members(tar, dest))
+            return result.get("exit_code", 0)
+        except Exception as ex:
+            logger.warning("Remote cache restore of %s failed: %s", key, ex)
+            return None
+
+    def put(self, key: str, src: str, outputs: List[str], exit_code: int, task: str = None):
+        """
+        Archives outputs (paths relative to src) now and uploads them in the background.
+        """
+        if not self.available:
+            return
+        archive = tempfile.TemporaryFile()
+        try:
+            if outputs:
+                with tarfile.open(fileobj=archive, mode="w:gz") as tar:
+                    for path in outputs:
+                        tar.add(os.path.join(src, path), arcname=path)
+        except Exception as ex:
+            archive.close()
+            logger.warning("Remote cache archive of %s failed: %s", key, ex)
+            return
+        future = concurrent.futures.Future()
+        self._jobs.put((future, (key, archive, bool(outputs), exit_code, task)))
+        self._pending.append(future)
+
+    def _upload(self, key: str, archive, has_outputs: bool, exit_code: int, task: str):
+        with archive:
+            digest = None
+            if has_outputs:
+                size = archive.tell()
+                archive.seek(0)
+                digest = hashlib.sha256()
+                for chunk in iter(lambda: archive.read(1024 * 1024), b""):
+                    digest.update(chunk)
+                digest = digest.hexdigest()
+                archive.seek(0)
+                headers = {"Content-Length": str(size), "Content-Type": "application/octet-stream"}
+                response = self._request("PUT", f"cas/{digest}", data=archive, headers=headers)
+                if response is None:
+                    return
+                response.close()
+
+            result = {"exit_code": exit_code, "archive": digest, "task": task, "created": time.time()}
+            headers = {"Content-Type": "application/json"}
+            response = self._request("PUT", f"ac/{key}", data=json.dumps(result).encode(), headers=headers)
+            if response is not None:
+                response.close()
+
+    def close(self, timeout: float = 60.0):
+        """
+        Waits up to timeout seconds for background uploads to finish. Uploads that haven't started by
+        then are dropped and ones still running are abandoned.
+        """
+        done, pending = concurrent.futures.wait(self._pending, timeout=timeout)
+        for f in done:
+            if f.exception() is not None:
+                logger.warning("Remote cache upload failed: %s", f.exception())
+        if pending:
+            logger.warning("Gave up on %d remote cache uploads", len(pending))
+        # drop uploads that haven't started along with their archives
+        while True:
+            try:
+                job = self._jobs.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None:
+                future, args = job
+                future.cancel()
+                args[1].close()
+        self._pending = []
+        for _ in self._workers:
+            self._jobs.put(None)
+
+
+_remote_cache: RemoteCache = None
+
+
+class _TaskRun(object):
+    """
+    Bookkeeping shared by _run_task and _run_task_async: task context, log grouping, timeout and metrics.
+    """
+
+    def __init__(self, task: TaskDefinition, args: Dict[str, Any], name: str = None):
+        self.task = task
+        self.name = name or task.name
+        self.context = _build_task_context(task)
+        self.context.args = args
+        if task.timeout is not None:
+            self.context.deadline = time.monotonic() + task.timeout
+        self.code: typing.Optional[int] = 1
+        self.status = "failed"
+        self.cache_key: str = None
+
+    def restore(self) -> bool:
+        """
+        Restores the task from the remote cache. Returns False on a miss or if the task isn't cacheable.
+        """
+        if _remote_cache is None or self.task.inputs is None:
+            return False
+        self.cache_key = _cache_key(self.task, self.context.args)
+        code = _remote_cache.get(self.cache_key, self.task.dir)
+        if code is None:
+            logger.debug("Cache miss for %s: %s", self.name, self.cache_key)
+            return False
+        logger.info("Restored %s from cache", self.name)
+        self.code, self.status = code, "cached"
+        return True
+
+    def save(self):
+        if self.cache_key is not None and self.status == "ok":
+            outputs = _glob_files(self.task.dir, self.task.outputs)
+            _remote_cache.put(self.cache_key, self.task.dir, outputs, self.code or 0, self.name)
+
+    def finish(self, ret) -> typing.Optional[int]:
+        """
+        Sets the exit code from what the task returned. None if it didn't return one.
+        """
+        if self.context.deadline is not None and time.monotonic() >= self.context.deadline:
+            return self.timed_out()
+        if isinstance(ret, CompletedProcess):
+            self.code = ret.returncode
+        elif isinstance(ret, int):
+            self.code = ret
+        else:
+            self.code = None
+        self.status = "ok" if not self.code else "failed"
+        return self.code
+
+    def timed_out(self) -> int:
+        logger.error("Task %s timed out after %ss", self.name, self.task.timeout)
+        self.code, self.status = TIMEOUT_RETURNCODE, "timeout"
+        return self.code
+
+    @contextlib.contextmanager
+    def scope(self):
+        token = _current_task.set(self.name)
+        start = time.monotonic()
+        try:
+            yield self
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            self.status = "cancelled"
+            raise
+        finally:
+            self.context.close()
+            _current_task.reset(token)
+            if _log_pipeline is not None:
+                _log_pipeline.task_done(self.name)
+            if _run_metrics is not None:
+                usage = self.context._usage
+                _run_metrics.add_task(
+                    TaskMetrics(
+                        name=self.name,
+                        task=self.task.name,
+                        duration=time.monotonic() - start,
+                        exit_code=self.code or 0,
+                        status=self.status,
+                        subprocesses=self.context._subprocesses,
+                        cpu_user=sum(u.user_time for u in usage),
+                        cpu_system=sum(u.system_time for u in usage),
+                        max_rss=max((u.max_rss for u in usage), default=0),
+                    )
+                )
+
+
+def _is_async_task(task: TaskDefinition) -> bool:
+    return inspect.iscoroutinefunction(task.func)
+
+
+_event_loop: asyncio.AbstractEventLoop = None
+
+
+def _get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Returns the event loop shared by every async task in the run.
+    """
+    global _event_loop
+
+    if _event_loop is None or _event_loop.is_closed():
+        _event_loop = asyncio.new_event_loop()
+    return _event_loop
+
+
+def _close_event_loop():
+    global _event_loop
+
+    if _event_loop is not None and not _event_loop.is_closed():
+        _event_loop.run_until_complete(_event_loop.shutdown_asyncgens())
+        _event_loop.close()
+    _event_loop = None
+
+
+def _run_until_complete(coro):
+    """
+    Runs coro on the shared event loop. On Ctrl-C every task still running is cancelled, and allowed to
+    clean up, before KeyboardInterrupt is raised again.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return asyncio.run(coro)
+
+    loop = _get_event_loop()
+    main = loop.create_task(coro)
+    try:
+        return loop.run_until_complete(main)
+    except KeyboardInterrupt:
+        pending = [t for t in asyncio.all_tasks(loop) if not t.done()]
+        for t in pending:
+            t.cancel()
+        loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        raise
+
+
+def _run_task(task: TaskDefinition, args: Dict[str, Any], name: str = None) -> typing.Optional[int]:
+    """
+    Runs one instance of a task. Returns its exit code or None if the task didn't return one.
+    """
+    run = _TaskRun(task, args, name)
+    with run.scope():
+        if run.restore():
+            return run.code
+        ret = task.func(run.context)
+        if inspect.isawaitable(ret):
+            ret = _run_until_complete(_await_task(run, ret))
+        else:
+            ret = run.finish(ret)
+        run.save()
+        return ret
+
+
+async def _run_task_async(task: TaskDefinition, args: Dict[str, Any], name: str = None) -> typing.Optional[int]:
+    """
+    Runs one instance of an async task on the running event loop.
+    """
+    run = _TaskRun(task, args, name)
+    with run.scope():
+        loop = asyncio.get_running_loop()
+        if await loop.run_in_executor(None, run.restore):
+            return run.code
+        ret = task.func(run.context)
+        if inspect.isawaitable(ret):
+            ret = await _await_task(run, ret)
+        else:
+            ret = run.finish(ret)
+        run.save()
+        return ret
+
+
+async def _await_task(run: _TaskRun, ret) -> typing.Optional[int]:
+    if run.context.deadline is None:
+        return run.finish(await ret)
+    try:
+        return run.finish(await asyncio.wait_for(ret, _remaining(None, run.context.deadline)))
+    except asyncio.TimeoutError:
+        return run.timed_out()
+
+
+def _log_matrix_summary(task: TaskDefinition, names: List[str], codes: List[int]) -> int:
+    """
+    Logs the result of each matrix instance. Returns the exit code of the first instance that failed, or 0.
+    """
+    failed = sum(1 for code in codes if code != 0)
+    logger.info("Matrix %s: %d passed, %d failed", task.name, len(codes) - failed, failed)
+    for name, code in zip(names, codes):
+        if code == 0:
+            logger.info("  PASS %s", name)
+        else:
+            logger.error("  FAIL %s (exit %d)", name, code)
+    return next((code for code in codes if code != 0), 0)
+
+
+def _run_matrix(task: TaskDefinition, instances: List[Dict[str, Any]], jobs: int) -> int:
+    """
+    Runs every instance of a matrix task, at most jobs at a time, and logs a summary.
+    Returns the exit code of the first instance that failed, or 0.
+    """
+    if _is_async_task(task):
+        return _run_until_complete(_run_matrix_async(task, instances, jobs))
+
+    names = [_format_task_instance(task.name, args) for args in instances]
+
+    def _run_instance(args, name):
+        try:
+            return _run_task(task, args, name) or 0
+        except Exception:
+            logging.getLogger(task.module).exception("Task failed: %s", name)
+            return 1
+
+    logger.info("Running %d instances of %s, %d at a time", len(instances), task.name, jobs)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="task")
+    try:
+        futures = [executor.submit(_run_instance, args, name) for args, name in zip(instances, names)]
+        codes = [f.result() for f in futures]
+    except BaseException:
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
+    return _log_matrix_summary(task, names, codes)
+
+
+async def _run_matrix_async(task: TaskDefinition, instances: List[Dict[str, Any]], jobs: int) -> int:
+    """
+    _run_matrix for async tasks. Instances run as coroutines on the event loop instead of threads.
+    """
+    names = [_format_task_instance(task.name, args) for args in instances]
+    limit = asyncio.Semaphore(jobs)
+
+    async def _run_instance(args, name):
+        async with limit:
+            try:
+                return await _run_task_async(task, args, name) or 0
+            except Exception:
+                logging.getLogger(task.module).exception("Task failed: %s", name)
+                return 1
+
+    logger.info("Running %d instances of %s, %d at a time", len(instances), task.name, jobs)
+    codes = await asyncio.gather(*[_run_instance(args, name) for args, name in zip(instances, names)])
+    return _log_matrix_summary(task, names, codes)
+
+
+async def _run_async_tasks(batch: List[typing.Tuple[TaskDefinition, List[Dict[str, Any]]]], jobs: int):
+    """
+    Runs a batch of async tasks concurrently. A task only waits on the dependencies that are part of
+    the batch, everything else has already run. Returns each task's exit code in batch order.
+    """
+    futures: Dict[str, asyncio.Future] = {}
+
+    async def _run(task, instances):
+        deps = [futures[dep] for dep in task.deps if dep in futures]
+        if deps:
+            await asyncio.gather(*deps)
+        if len(instances) > 1:
+            return await _run_matrix_async(task, instances, jobs)
+        return await _run_task_async(task, instances[0])
+
+    for task, instances in batch:
+        futures[task.name] = asyncio.ensure_future(_run(task, instances))
+    try:
+        return await asyncio.gather(*futures.values())
+    except BaseException:
+        for f in futures.values():
+            f.cancel()
+        await asyncio.gather(*futures.values(), return_exceptions=True)
+        raise
+
+
+# how many times a task is sent to a worker before it is failed
+WORKER_ATTEMPTS = 3
+
+# send() for the coordinator connection of the task running on this thread
+_worker_sender = contextvars.ContextVar("worker_sender", default=None)
+
+
+def _parse_address(address: str, default_port: int = 7070) -> typing.Tuple[str, int]:
+    host, _, port = address.strip().rpartition(":")
+    if not host:
+        return port or "127.0.0.1", default_port
+    return host.strip("[]"), int(port)
+
+
+class _WorkerLogHandler(logging.Handler):
+    """
+    Forwards records logged while a worker runs a task to the coordinator that sent it.
+    """
+
+    def emit(self, record: logging.LogRecord):
+        send = _worker_sender.get()
+        if send is None:
+            return
+        msg = record.getMessage()
+        if record.exc_info:
+            msg = f"{msg}\n{logging.Formatter().formatException(record.exc_info)}"
+        try:
+            send({"op": "log", "name": record.name, "level": record.levelno, "msg": msg})
+        except OSError:
+            pass
+
+
+class _WorkerRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Speaks newline delimited JSON with a coordinator:
+        worker -> {"op": "hello", "tasks": [...]}
+        coordinator -> {"op": "run", "id": 1, "task": "test", "name": "test[py=3.9]", "args": {"py": "3.9"}}
+        worker -> {"op": "log", "id": 1, "name": "test", "level": 20, "msg": "..."} ...
+        worker -> {"op": "done", "id": 1, "code": 0}
+    """
+
+    def setup(self):
+        super().setup()
+        self.lock = threading.Lock()
+
+    def send(self, msg: Dict[str, Any]):
+        with self.lock:
+            self.wfile.write(json.dumps(msg).encode() + b"\n")
+            self.wfile.flush()
+
+    def handle(self):
+        tasks: Dict[str, TaskDefinition] = self.server.tasks
+        self.send({"op": "hello", "tasks": sorted(tasks.keys())})
+        for line in self.rfile:
+            msg = json.loads(line)
+            if msg.get("op") == "run":
+                self.run(tasks, msg)
+
+    def run(self, tasks: Dict[str, TaskDefinition], msg: Dict[str, Any]):
+        task = tasks.get(msg["task"])
+        name = msg.get("name") or msg["task"]
+        logger.info("Running %s for %s", name, self.client_address[0])
+        token = _worker_sender.set(lambda m: self.send({**m, "id": msg["id"]}))
+        code = 1
+        try:
+            if task is None:
+                logger.error("Unknown task: %s", msg["task"])
+            else:
+                code = _run_task(task, msg.get("args", {}), name)
+        except Exception:
+            logger.exception("Task failed: %s", name)
+        finally:
+            _worker_sender.reset(token)
+        self.send({"op": "done", "id": msg["id"], "code": code})
+
+
+class WorkerServer(socketserver.ThreadingTCPServer):
+    """
+    Serves tasks to coordinators started with --workers.
+
+    Args:
+    - tasks (dict): Task name to TaskDefinition, as loaded from this checkout.
+    - address (tuple): (host, port) to listen on. Port 0 picks a free port.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, tasks: Dict[str, TaskDefinition], address: typing.Tuple[str, int]):
+        self.tasks = tasks
+        self.log_handler = _WorkerLogHandler()
+        super().__init__(address, _WorkerRequestHandler)
+        logging.getLogger().addHandler(self.log_handler)
+
+    @property
+    def address(self) -> str:
+        host, port = self.server_address[:2]
+        return f"{host}:{port}"
+
+    def server_close(self):
+        logging.getLogger().removeHandler(self.log_handler)
+        super().server_close()
+
+
+class _WorkUnit(object):
+    def __init__(self, task: TaskDefinition, name: str, args: Dict[str, Any], deps: typing.Set[str]):
+        self.task = task
+        self.name = name
+        self.args = args
+        self.deps = deps
+        self.attempts = 0
+
+
+class _Scheduler(object):
+    """
+    Hands units to worker threads once everything they depend on has finished. A unit only goes to a
+    worker that offers its task.
+    """
+
+    def __init__(self, units: List[_WorkUnit], workers: int):
+        self.pending = list(units)
+        self.running: typing.Set[str] = set()
+        self.codes: Dict[str, typing.Optional[int]] = {}
+        self.live = workers
+        # task names offered by each connected worker thread, keyed by thread id
+        self.offers: Dict[int, typing.Set[str]] = {}
+        self.cond = threading.Condition()
+
+    def connected(self, tasks: typing.Set[str]):
+        with self.cond:
+            self.offers[threading.get_ident()] = tasks
+            self._fail_unroutable()
+
+    def take(self, tasks: typing.Set[str]) -> typing.Optional[_WorkUnit]:
+        # keeps waiting while anything is still running, a lost worker may hand its unit back
+        with self.cond:
+            while self.pending or self.running:
+                for unit in self.pending:
+                    if unit.task.name in tasks and unit.deps.issubset(self.codes.keys()):
+                        self.pending.remove(unit)
+                        self.running.add(unit.name)
+                        return unit
+                self.cond.wait()
+            return None
+
+    def finish(self, unit: _WorkUnit, code: typing.Optional[int]):
+        with self.cond:
+            self.running.discard(unit.name)
+            self.codes[unit.name] = code
+            self.cond.notify_all()
+
+    def retry(self, unit: _WorkUnit):
+        with self.cond:
+            self.running.discard(unit.name)
+            unit.attempts += 1
+            if unit.attempts >= WORKER_ATTEMPTS:
+                logger.error("Giving up on %s after %d attempts", unit.name, unit.attempts)
+                self.codes[unit.name] = 1
+            else:
+                self.pending.insert(0, unit)
+            self.cond.notify_all()
+
+    def worker_done(self):
+        with self.cond:
+            self.live -= 1
+            self.offers.pop(threading.get_ident(), None)
+            self._fail_unroutable()
+            self.cond.notify_all()
+
+    def _fail_unroutable(self):
+        """
+        Fails pending units that no worker offers, once every live worker has said what it offers.
+        """
+        if self.live == 0 and self.pending:
+            logger.error("No workers left, %d tasks were not run", len(self.pending))
+        elif len(self.offers) < self.live:
+            return
+        offered = set().union(*self.offers.values())
+        for unit in [u for u in self.pending if u.task.name not in offered]:
+            if self.live:
+                logger.error("No worker offers task %s, %s was not run", unit.task.name, unit.name)
+            self.codes[unit.name] = 1
+            self.pending.remove(unit)
+        self.cond.notify_all()
+
+
+def _dispatch(unit: _WorkUnit, rfile, wfile, address: str, msg_id: int) -> typing.Optional[int]:
+    """
+    Sends unit to a worker and re-logs what it sends back until it is done. Returns the exit code.
+    """
+    msg = {"op": "run", "id": msg_id, "task": unit.task.name, "name": unit.name, "args": unit.args}
+    wfile.write(json.dumps(msg).encode() + b"\n")
+    wfile.flush()
+    for line in rfile:
+        reply = json.loads(line)
+        if reply.get("op") == "log":
+            logging.getLogger(reply["name"]).log(reply["level"], "%s", reply["msg"])
+        elif reply.get("op") == "done" and reply.get("id") == msg_id:
+            return reply["code"]
+    raise ConnectionError(f"worker {address} disconnected")
+
+
+def _drive_worker(address: str, scheduler: _Scheduler):
+    """
+    Feeds units from scheduler to one worker until there is nothing left or the worker fails.
+    """
+    try:
+        _feed_worker(address, scheduler)
+    finally:
+        scheduler.worker_done()
+
+
+def _feed_worker(address: str, scheduler: _Scheduler):
+    try:
+        sock = socket.create_connection(_parse_address(address), timeout=10)
+        sock.settimeout(None)
+    except OSError as ex:
+        logger.error("Worker %s unavailable: %s", address, ex)
+        return
+
+    with sock, sock.makefile("rb") as rfile, sock.makefile("wb") as wfile:
+        unit = None
+        try:
+            hello = json.loads(rfile.readline() or b"{}")
+            tasks = set(hello.get("tasks", []))
+            logger.debug("Connected to worker %s with %d tasks", address, len(tasks))
+            scheduler.connected(tasks)
+            msg_id = 0
+            while True:
+                unit = scheduler.take(tasks)
+                if unit is None:
+                    return
+                msg_id += 1
+                token = _current_task.set(unit.name)
+                start = time.monotonic()
+                try:
+                    logger.debug("Running %s on %s", unit.name, address)
+                    code = _dispatch(unit, rfile, wfile, address, msg_id)
+                finally:
+                    _current_task.reset(token)
+                    if _log_pipeline is not None:
+                        _log_pipeline.task_done(unit.name)
+                if _run_metrics is not None:
+                    status = "ok" if not code else "timeout" if code == TIMEOUT_RETURNCODE else "failed"
+                    _run_metrics.add_task(
+                        TaskMetrics(unit.name, unit.task.name, time.monotonic() - start, code or 0, status, 0)
+                    )
+                scheduler.finish(unit, code)
+                unit = None
+        except Exception as ex:
+            # a connection error or a reply that doesn't make sense, either way the unit goes elsewhere
+            logger.error("Lost worker %s: %r", address, ex)
+            if unit is not None:
+                scheduler.retry(unit)
+
+
+def _run_distributed(
+    resolved_tasks: List[str],
+    tasks: Dict[str, TaskDefinition],
+    tasks_with_args: Dict[str, Dict[str, Any]],
+    workers: List[str],
+) -> int:
+    """
+    Runs resolved_tasks on workers. Each matrix instance is a separate unit of work. A unit waits on
+    every unit of the tasks it depends on. Returns the exit code the same way the local loop does.
+    """
+    units: Dict[str, List[_WorkUnit]] = {}
+    for task_name in resolved_tasks:
+        if task_name not in tasks:
+            continue
+        task = tasks[task_name]
+        instances = _expand_task_matrix(tasks_with_args.get(task_name, {}), task.matrix)
+        deps = {u.name for dep in task.deps for u in units.get(dep, [])}
+        units[task_name] = [
+            _WorkUnit(task, _format_task_instance(task.name, args) if len(instances) > 1 else task.name, args, deps)
+            for args in instances
+        ]
+
+    scheduler = _Scheduler([u for task_units in units.values() for u in task_units], len(workers))
+    logger.info("Running %d tasks on %d workers", len(scheduler.pending), len(workers))
+    threads = [
+        threading.Thread(target=_drive_worker, args=(address, scheduler), name=f"worker-{address}", daemon=True)
+        for address in workers
+    ]
+    for t in threads:
+        t.start()
+    try:
+        for t in threads:
+            t.join()
+    except KeyboardInterrupt:
+        logger.warning("Interrupted, %d tasks did not finish", len(scheduler.pending) + len(scheduler.running))
+
+    ret_code = 0
+    for task_name, task_units in units.items():
+        codes = [scheduler.codes.get(u.name, 1) for u in task_units]
+        if len(task_units) > 1:
+            ret = _log_matrix_summary(task_units[0].task, [u.name for u in task_units], [c or 0 for c in codes])
+        else:
+            ret = codes[0]
+        if ret is not None:
+            ret_code = ret
+    return ret_code
+
+
+def _serve_worker(tasks: Dict[str, TaskDefinition], listen: str):
+    server = WorkerServer(tasks, _parse_address(listen))
+    logger.info("Worker listening on %s with %d tasks", server.address, len(tasks))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def _run_async_batch(batch, jobs: int, ret_code: int) -> int:
+    """
+    Runs and empties the pending batch of async tasks. Returns the exit code of the run so far.
+    """
+    if not batch:
+        return ret_code
+    try:
+        for ret in _run_until_complete(_run_async_tasks(list(batch), max(1, jobs))):
+            if ret is not None:
+                ret_code = ret
+    except KeyboardInterrupt:
+        pass
+    finally:
+        batch.clear()
+    return ret_code
+
+
 def _process_tasks():
 
     # need to boostrap this arg so that we can enable debug logging at
@@ -520,10 +2839,23 @@ def _process_tasks():
     if "-q" in raw_args or "--quiet" in raw_args:
         logger.setLevel(QUIET_LEVEL)
 
+    _start_log_pipeline()
+    try:
+        _run_tasks(raw_args)
+    finally:
+        _stop_log_pipeline()
+
+
+def _run_tasks(raw_args: List[str]):
+    global _run_metrics, _remote_cache
+
     logger.info("Processing tasks")
+    metrics = RunMetrics()
 
-    task_files = _find_task_files()
-    task_defs = _load_task_definitions(task_files)
+    with metrics.phase("discovery"):
+        task_files = _find_task_files()
+    with metrics.phase("load"):
+        task_defs = _load_task_definitions(task_files)
     # { 'task_name': TaskDefinition }
     tasks: typing.Dict[str, TaskDefinition] = {}
 
@@ -532,10 +2864,16 @@ def _process_tasks():
     parser.add_argument("-h", "--help", action="store_true")
     parser.add_argument("-v", "--verbose", action="store_true")
     parser.add_argument("-q", "--quiet", action="store_true")
+    parser.add_argument("-j", "--jobs", type=int, default=int(os.environ.get("TASK_JOBS", 0)) or os.cpu_count())
+    parser.add_argument("--metrics", default=os.environ.get("TASK_METRICS"))
+    parser.add_argument("--cache-url", default=os.environ.get("TASK_CACHE_URL"))
+    parser.add_argument("--workers", default=os.environ.get("TASK_WORKERS"))
+    parser.add_argument("--listen", default=os.environ.get("TASK_WORKER_LISTEN", "127.0.0.1:7070"))
 
     # configure tasks
-    for task_def in task_defs:
-        tasks.update(_load_tasks(task_def))
+    with metrics.phase("configure"):
+        for task_def in task_defs:
+            tasks.update(_load_tasks(task_def))
 
     args = parser.parse_args()
 
@@ -551,6 +2889,16 @@ def _process_tasks():
 
     task_names = list(tasks_with_args.keys())
 
+    if task_names == ["worker"] and "worker" not in tasks:
+        _remote_cache = RemoteCache(args.cache_url) if args.cache_url else None
+        try:
+            _serve_worker(tasks, args.listen)
+        finally:
+            if _remote_cache is not None:
+                _remote_cache.close()
+                _remote_cache = None
+        return
+
     if len(task_names) == 0 or args.help:
         _print_help(tasks.keys())
         return
@@ -571,24 +2919,60 @@ def _process_tasks():
     #       }
     #   },
     # ]
-    tasks_with_deps = [{k: {"deps": v.deps}} for k, v in tasks.items()]
-    resolved_tasks = _resolve_deps(task_names, tasks_with_deps)
+    with metrics.phase("resolve"):
+        tasks_with_deps = [{k: {"deps": v.deps}} for k, v in tasks.items()]
+        resolved_tasks = _resolve_deps(task_names, tasks_with_deps)
 
     # runtime
     ret_code = 0
-    for task_name in resolved_tasks:
-        if task_name in tasks:
-            task = tasks[task_name]
+    _run_metrics = metrics
+    if args.cache_url:
+        _remote_cache = RemoteCache(args.cache_url)
+    async_batch = []
+    try:
+        if args.workers:
+            workers = [w.strip() for w in args.workers.split(",") if w.strip()]
+            ret_code = _run_distributed(resolved_tasks, tasks, tasks_with_args, workers)
+        else:
+            for task_name in resolved_tasks:
+                if task_name not in tasks:
+                    metrics.add_task(TaskMetrics(task_name, task_name, 0.0, 0, "skipped", 0))
+                    continue
+                task = tasks[task_name]
+                instances = _expand_task_matrix(tasks_with_args.get(task_name, {}), task.matrix)
+                if _is_async_task(task):
+                    # async tasks are batched until the next sync task so that independent ones overlap
+                    async_batch.append((task, instances))
+                    continue
+                ret_code = _run_async_batch(async_batch, args.jobs, ret_code)
+                try:
+                    if len(instances) > 1:
+                        ret = _run_matrix(task, instances, max(1, args.jobs))
+                    else:
+                        ret = _run_task(task, instances[0])
+                    if ret is not None:
+                        ret_code = ret
+                except KeyboardInterrupt:
+                    pass
+            ret_code = _run_async_batch(async_batch, args.jobs, ret_code)
+    except BaseException:
+        # the traceback exits the process with 1
+        ret_code = ret_code or 1
+        raise
+    finally:
+        _close_event_loop()
+        if _remote_cache is not None:
+            _remote_cache.close()
+            _remote_cache = None
+        _run_metrics = None
+        if args.verbose and metrics.execs:
+            logger.info("Resource usage:\n%s", metrics.usage_summary())
+        if args.metrics:
+            metrics.exit_code = ret_code
             try:
-                task_context = _build_task_context(task)
-                task_context.args = tasks_with_args.get(task_name, {})
-                ret = task.func(task_context)
-                if isinstance(ret, CompletedProcess):
-                    ret_code = ret.returncode
-                elif isinstance(ret, int):
-                    ret_code = ret
-            except KeyboardInterrupt:
-                pass
+                metrics.write(args.metrics)
+            except OSError:
+                logger.exception("Error writing metrics: %s", args.metrics)
     sys.exit(ret_code)
 
 
@@ -1,6 +1,49 @@
+import asyncio
+import io
+import json
+import logging
+import os
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import urllib.error
+import urllib.request
+from unittest import mock
 
-from __tasklib__ import _build_system_distro, _parse_task_args, _resolve_deps
+from __tasklib__ import (
+    CapturedOutput,
+    LogPipeline,
+    QUIET_LEVEL,
+    RemoteCache,
+    RunMetrics,
+    ShellSession,
+    TIMEOUT_RETURNCODE,
+    TaskDefinition,
+    TaskMetrics,
+    WorkerServer,
+    _LogPipelineHandler,
+    _build_system_distro,
+    _cache_key,
+    _close_event_loop,
+    _expand_task_matrix,
+    _parse_task_args,
+    _resolve_deps,
+    _run_async_tasks,
+    _run_distributed,
+    _run_matrix,
+    _run_task,
+    _run_until_complete,
+    _start_log_pipeline,
+    _stop_log_pipeline,
+    aexec,
+    exec,
+    pipe,
+)
 
 
 class TestResolveDeps(unittest.TestCase):
@@ -99,6 +142,857 @@ class TestParseTaskArgs(unittest.TestCase):
         result = _parse_task_args(task_args)
         self.assertEqual(result, {"arg1": ""})
 
+    def test_parse_matrix_argument(self):
+        task_args = "task[py=3.9|3.10, db = pg | mysql, verbose]"
+        result = _parse_task_args(task_args)
+        self.assertEqual(result, {"py": ["3.9", "3.10"], "db": ["pg", "mysql"], "verbose": None})
+
+
+class TestExpandTaskMatrix(unittest.TestCase):
+    def test_no_matrix(self):
+        self.assertEqual(_expand_task_matrix({"a": "1"}), [{"a": "1"}])
+        self.assertEqual(_expand_task_matrix({}), [{}])
+
+    def test_args(self):
+        result = _expand_task_matrix({"py": ["3.9", "3.10"], "db": ["pg", "mysql"], "x": None})
+        self.assertEqual(
+            result,
+            [
+                {"x": None, "py": "3.9", "db": "pg"},
+                {"x": None, "py": "3.9", "db": "mysql"},
+                {"x": None, "py": "3.10", "db": "pg"},
+                {"x": None, "py": "3.10", "db": "mysql"},
+            ],
+        )
+
+    def test_declared_matrix(self):
+        matrix = {"py": ["3.9", "3.10"], "db": ["pg", "mysql"]}
+        self.assertEqual(len(_expand_task_matrix({}, matrix)), 4)
+        self.assertEqual(
+            _expand_task_matrix({"db": "pg"}, matrix),
+            [{"db": "pg", "py": "3.9"}, {"db": "pg", "py": "3.10"}],
+        )
+        self.assertEqual(
+            _expand_task_matrix({"py": ["3.11"]}, matrix),
+            [{"py": "3.11", "db": "pg"}, {"py": "3.11", "db": "mysql"}],
+        )
+
+
+class TestRunMatrix(unittest.TestCase):
+    def _task(self, func):
+        return TaskDefinition(func=func, module="test", name="test", filename=__file__, dir=os.curdir)
+
+    def test_concurrent(self):
+        barrier = threading.Barrier(3, timeout=5)
+
+        def _func(ctx):
+            barrier.wait()
+            return 2 if ctx.args["n"] == "2" else 0
+
+        instances = _expand_task_matrix({"n": ["1", "2", "3"]})
+        self.assertEqual(_run_matrix(self._task(_func), instances, jobs=3), 2)
+
+    def test_exception(self):
+        def _func(ctx):
+            if ctx.args["n"] == "1":
+                raise RuntimeError("boom")
+
+        instances = _expand_task_matrix({"n": ["1", "2"]})
+        self.assertEqual(_run_matrix(self._task(_func), instances, jobs=1), 1)
+
+
+class TestLogPipeline(unittest.TestCase):
+    def _record(self, msg, task=None):
+        record = logging.LogRecord("test", logging.INFO, __file__, 1, msg, None, None)
+        record.task = task
+        return record
+
+    def _run(self, mode, records):
+        stream = io.StringIO()
+        pipeline = LogPipeline(stream, logging.Formatter("%(message)s"), mode=mode)
+        pipeline.start()
+        for record in records:
+            if isinstance(record, str):
+                pipeline.task_done(record)
+            else:
+                pipeline.put(record)
+        pipeline.stop()
+        return stream.getvalue().splitlines()
+
+    def test_stream(self):
+        records = [self._record("a1", "a"), self._record("b1", "b"), self._record("a2", "a")]
+        self.assertEqual(self._run("stream", records), ["a1", "b1", "a2"])
+
+    def test_grouped(self):
+        records = [
+            self._record("a1", "a"),
+            self._record("b1", "b"),
+            self._record("runner"),
+            self._record("a2", "a"),
+            "a",
+            self._record("b2", "b"),
+        ]
+        self.assertEqual(self._run("grouped", records), ["runner", "a1", "a2", "b1", "b2"])
+
+    def test_prefixed(self):
+        records = [self._record("a1", "a"), self._record("runner")]
+        self.assertEqual(self._run("prefixed", records), ["[a] a1", "runner"])
+
+    def test_flush(self):
+        stream = io.StringIO()
+        pipeline = LogPipeline(stream, logging.Formatter("%(message)s"))
+        pipeline.start()
+        pipeline.put(self._record("hello"))
+        pipeline.flush()
+        self.assertEqual(stream.getvalue(), "hello\n")
+        pipeline.stop()
+
+    def test_malformed_record(self):
+        stream = io.StringIO()
+        errors = []
+        pipeline = LogPipeline(stream, logging.Formatter("%(message)s"), handle_error=errors.append)
+        pipeline.start()
+        bad = logging.LogRecord("test", logging.INFO, __file__, 1, "count=%d", ("x",), None)
+        pipeline.put(bad)
+        pipeline.put(self._record("still logging"))
+        pipeline.flush()
+        self.assertEqual(stream.getvalue(), "still logging\n")
+        self.assertEqual(errors, [bad])
+        pipeline.stop()
+
+    def test_message_is_rendered_when_logged(self):
+        stream = io.StringIO()
+        pipeline = LogPipeline(stream, logging.Formatter("%(message)s"))
+        handler = _LogPipelineHandler(pipeline)
+        log = logging.getLogger("test.pipeline")
+        log.addHandler(handler)
+        log.propagate = False
+        pipeline.start()
+        try:
+            state = {"n": 1}
+            log.warning("state=%s", state)
+            state["n"] = 2
+            with mock.patch.object(handler, "handleError") as handle_error:
+                log.warning("count=%d", "x")
+            handle_error.assert_called_once()
+            pipeline.flush()
+        finally:
+            log.removeHandler(handler)
+            log.propagate = True
+            pipeline.stop()
+        self.assertEqual(stream.getvalue(), "state={'n': 1}\n")
+
+    def test_broken_stream(self):
+        stream = io.StringIO()
+        stream.close()
+        errors = []
+        pipeline = LogPipeline(stream, logging.Formatter("%(message)s"), handle_error=errors.append)
+        pipeline.start()
+        pipeline.put(self._record("lost"))
+        pipeline.flush()
+        pipeline.put(self._record("lost too"))
+        pipeline.flush()
+        self.assertEqual(len(errors), 2)
+        pipeline.stop()
+
+    def test_flush_dead_writer(self):
+        pipeline = LogPipeline(io.StringIO(), logging.Formatter("%(message)s"))
+        pipeline.start()
+        pipeline.stop()
+        pipeline._thread = threading.Thread(target=lambda: None)
+        pipeline._thread.start()
+        pipeline._thread.join()
+        pipeline.flush()
+
+    def test_invalid_mode(self):
+        with self.assertRaises(ValueError):
+            LogPipeline(io.StringIO(), logging.Formatter(), mode="bogus")
+
+    def test_quiet_skips_pipeline(self):
+        root = logging.getLogger()
+        level = root.level
+        root.setLevel(QUIET_LEVEL)
+        try:
+            self.assertIsNone(_start_log_pipeline())
+            self.assertEqual(logging.root.manager.disable, QUIET_LEVEL - 1)
+        finally:
+            _stop_log_pipeline()
+            root.setLevel(level)
+        self.assertEqual(logging.root.manager.disable, logging.NOTSET)
+
+
+class TestPipe(unittest.TestCase):
+    def test_capture(self):
+        result = pipe(["printf 'b\\na\\nc\\n'", "sort", "head -n 2"], capture=True)
+        self.assertEqual(result.stdout, "a\nb\n")
+        self.assertEqual(result.returncodes, [0, 0, 0])
+        self.assertEqual(result.returncode, 0)
+
+    def test_pipefail(self):
+        result = pipe(["sh -c 'echo oops >&2; exit 3'", "cat", "true"], capture=True)
+        self.assertEqual(result.returncodes, [3, 0, 0])
+        self.assertEqual(result.returncode, 3)
+        self.assertEqual(result.stderr, "oops\n")
+
+    def test_input(self):
+        self.assertEqual(pipe(["cat", "tr a-z A-Z"], input="hello", capture=True).stdout, "HELLO")
+        self.assertEqual(pipe(["tr a-z A-Z"], input="hello", capture=True).stdout, "HELLO")
+
+    def test_early_exit(self):
+        result = pipe(["yes", "head -n 2"], capture=True)
+        self.assertEqual(result.stdout, "y\ny\n")
+        self.assertEqual(result.returncodes[-1], 0)
+
+    def test_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            src = os.path.join(tmp, "src.txt")
+            dst = os.path.join(tmp, "dst.txt")
+            with open(src, "w") as f:
+                f.write("hello\n")
+            pipe(["cat", "tr a-z A-Z"], stdin=src, stdout=dst)
+            pipe(["cat"], stdin=src, stdout=dst, append=True)
+            with open(dst) as f:
+                self.assertEqual(f.read(), "HELLO\nhello\n")
+
+    def test_missing_command(self):
+        result = pipe(["echo hi", "this-command-does-not-exist"], capture=True)
+        self.assertEqual(len(result.returncodes), 2)
+        self.assertEqual(result.returncodes[-1], 1)
+        self.assertNotEqual(result.returncode, 0)
+
+
+class _StreamRecorder(object):
+    # stands in for sys.stdout / sys.stderr, records (name, data) for each write to its buffer
+    def __init__(self, name, writes):
+        self.name = name
+        self.writes = writes
+        self.buffer = self
+
+    def write(self, data):
+        if data:
+            self.writes.append((self.name, data))
+
+    def flush(self):
+        pass
+
+
+class TestShellSession(unittest.TestCase):
+    def test_run(self):
+        with ShellSession() as sh:
+            result = sh.run("echo out; echo err >&2; exit_code=3; (exit $exit_code)", capture=True)
+            self.assertEqual(result.returncode, 3)
+            self.assertEqual(result.stdout, "out\n")
+            self.assertEqual(result.stderr, "err\n")
+
+    def test_no_trailing_newline(self):
+        with ShellSession() as sh:
+            self.assertEqual(sh.run(["printf", "%s", "a b"], capture=True).stdout, "a b")
+
+    def test_state_is_kept(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with ShellSession() as sh:
+                sh.run(f"cd {tmp} && export GREETING=hello", capture=True)
+                self.assertEqual(sh.run("pwd", capture=True).stdout.strip(), os.path.realpath(tmp))
+                self.assertEqual(sh.run("echo $GREETING", capture=True).stdout, "hello\n")
+
+    def test_pass_through_interleaves(self):
+        writes = []
+        with ShellSession() as sh:
+            with mock.patch("sys.stdout", _StreamRecorder("out", writes)), mock.patch(
+                "sys.stderr", _StreamRecorder("err", writes)
+            ):
+                result = sh.run("echo e1 >&2; sleep 0.3; echo o1; sleep 0.3; echo e2 >&2")
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(writes, [("err", b"e1\n"), ("out", b"o1\n"), ("err", b"e2\n")])
+
+    def test_pass_through_marker_prefix(self):
+        # output that looks like the start of a marker is held back until it is known not to be one
+        writes = []
+        with ShellSession() as sh:
+            with mock.patch("sys.stdout", _StreamRecorder("out", writes)):
+                sh.run("printf __ta; sleep 0.2; printf sk")
+        self.assertEqual(b"".join(data for _, data in writes), b"__task")
+
+    def test_pass_through_text_stream(self):
+        stdout = io.StringIO()
+        with ShellSession() as sh:
+            with mock.patch("sys.stdout", stdout), mock.patch("locale.getpreferredencoding", return_value="utf-8"):
+                # one character split across two reads
+                result = sh.run("printf '\\303'; sleep 0.2; printf '\\251\\n'")
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(stdout.getvalue(), "\u00e9\n")
+
+    def test_close_after_timeout(self):
+        sh = ShellSession()
+        self.assertTrue(sh.run("sleep 30", capture=True, timeout=0.2).timed_out)
+        sh.close()
+        self.assertTrue(sh._proc.stdin.closed)
+
+    def test_exit(self):
+        sh = ShellSession()
+        self.assertEqual(sh.run("exit 4", capture=True).returncode, 4)
+        self.assertTrue(sh.closed)
+        with self.assertRaises(RuntimeError):
+            sh.run("true")
+        sh.close()
+
+
+class TestCapturedOutput(unittest.TestCase):
+    def test_in_memory(self):
+        out = CapturedOutput(limit=1024, tail_lines=2)
+        out.write(b"one\ntwo\nth")
+        out.write(b"ree\nfour")
+        out.finish()
+        self.assertFalse(out.spilled)
+        self.assertEqual(out.read(), b"one\ntwo\nthree\nfour")
+        self.assertEqual(out.tail, ["three", "four"])
+        self.assertEqual(bytes(out.mmap()), out.read())
+
+    def test_spill(self):
+        out = CapturedOutput(limit=8)
+        out.write(b"12345")
+        out.write(b"67890\n")
+        out.finish()
+        self.assertTrue(out.spilled)
+        self.assertTrue(os.path.exists(out.path))
+        self.assertEqual(len(out), 11)
+        with out.mmap() as data:
+            self.assertEqual(data[:], b"1234567890\n")
+        self.assertEqual(out.text(), "1234567890\n")
+        out.close()
+        self.assertFalse(os.path.exists(out.path))
+
+    def test_exec(self):
+        result = exec(
+            ["sh", "-c", "seq 1 1000; echo failed >&2; exit 2"], capture=True, capture_limit=100, tail_lines=3
+        )
+        self.assertEqual(result.returncode, 2)
+        self.assertTrue(result.stdout.spilled)
+        self.assertEqual(result.stdout.tail, ["998", "999", "1000"])
+        self.assertEqual(result.stdout.text().splitlines()[0], "1")
+        self.assertEqual(result.stderr.tail, ["failed"])
+        self.assertFalse(result.stderr.spilled)
+        result.stdout.close()
+
+    def test_exec_input(self):
+        result = exec("cat", capture=True, capture_limit=100, input="hello")
+        self.assertEqual(result.stdout.read(), b"hello")
+
+    def test_exec_missing_command(self):
+        result = exec("no-such-command-xyz", capture=True, capture_limit=100)
+        self.assertEqual(result.returncode, 1)
+        self.assertEqual(result.stdout.read(), b"")
+        self.assertIn("no-such-command-xyz", "\n".join(result.stderr.tail))
+
+    def test_exec_no_time_left(self):
+        result = exec("true", capture=True, capture_limit=100, timeout=0)
+        self.assertTrue(result.timed_out)
+        self.assertEqual(result.stderr.tail, [])
+
+
+class TestResourceUsage(unittest.TestCase):
+    def test_exec_usage(self):
+        result = exec(
+            [sys.executable, "-c", "x = bytearray(64 * 2**20); sum(range(10**6)); print('ok')"], capture=True
+        )
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.stdout, "ok\n")
+        self.assertGreater(result.usage.max_rss, 64 * 2**20)
+        self.assertGreater(result.usage.user_time + result.usage.system_time, 0)
+        self.assertGreaterEqual(result.usage.wall_time, result.usage.user_time / os.cpu_count())
+
+    def test_exec_usage_exit_code(self):
+        result = exec(["sh", "-c", "exit 3"])
+        self.assertEqual(result.returncode, 3)
+        self.assertIsNotNone(result.usage)
+
+    def test_task_rollup(self):
+        def _func(ctx):
+            ctx.exec([sys.executable, "-c", "x = bytearray(64 * 2**20)"])
+            ctx.exec("true")
+
+        metrics = RunMetrics()
+        task = TaskDefinition(func=_func, module="test", name="test", filename=__file__, dir=os.curdir)
+        with mock.patch("__tasklib__._run_metrics", metrics):
+            _run_task(task, {})
+        self.assertEqual(len(metrics.execs), 2)
+        self.assertGreater(metrics.tasks[0].max_rss, 64 * 2**20)
+        self.assertGreater(metrics.tasks[0].cpu_user + metrics.tasks[0].cpu_system, 0)
+        summary = metrics.usage_summary(top=1)
+        self.assertIn("Top 1 commands by peak rss", summary)
+        self.assertIn("bytearray", summary)
+
+
+class TestTimeouts(unittest.TestCase):
+    def _alive(self, pid):
+        # the orphaned child may linger as a zombie until init reaps it
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                return f.read().split()[2] != "Z"
+        except FileNotFoundError:
+            return False
+
+    def test_exec_timeout_kills_group(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pid_file = os.path.join(tmp, "pid")
+            start = time.monotonic()
+            result = exec(["sh", "-c", f"sleep 30 & echo $! > {pid_file}; wait"], timeout=0.5)
+            self.assertLess(time.monotonic() - start, 5)
+            self.assertTrue(result.timed_out)
+            self.assertEqual(result.returncode, TIMEOUT_RETURNCODE)
+            with open(pid_file) as f:
+                pid = int(f.read())
+            time.sleep(0.1)
+            self.assertFalse(self._alive(pid))
+
+    @mock.patch("__tasklib__.KILL_GRACE", 0.2)
+    def test_exec_timeout_escalates(self):
+        result = exec(["sh", "-c", "trap '' TERM; sleep 30"], capture=True, timeout=0.2)
+        self.assertTrue(result.timed_out)
+
+    def test_exec_timeout_captured(self):
+        result = exec(["sh", "-c", "echo started; sleep 30"], capture=True, capture_limit=10, timeout=0.2)
+        self.assertTrue(result.timed_out)
+        self.assertEqual(result.stdout.tail, ["started"])
+
+    def test_exec_no_timeout(self):
+        result = exec(["sh", "-c", "echo ok"], capture=True, timeout=10)
+        self.assertFalse(result.timed_out)
+        self.assertEqual(result.stdout, "ok\n")
+
+    def test_task_timeout(self):
+        def _func(ctx):
+            ctx.exec("sleep 30")
+            return ctx.exec("echo never", capture=True)
+
+        task = TaskDefinition(func=_func, module="test", name="test", filename=__file__, dir=os.curdir, timeout=0.3)
+        start = time.monotonic()
+        self.assertEqual(_run_task(task, {}), TIMEOUT_RETURNCODE)
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_pipe_timeout(self):
+        start = time.monotonic()
+        result = pipe(["sh -c 'echo started; sleep 30'", "cat", "sleep 30"], capture=True, timeout=0.3)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertTrue(result.timed_out)
+        self.assertEqual(result.returncodes, [TIMEOUT_RETURNCODE] * 3)
+        self.assertEqual(result.returncode, TIMEOUT_RETURNCODE)
+
+    def test_pipe_timeout_reports_finished_stages(self):
+        result = pipe(["sleep 30", "true"], timeout=0.3)
+        self.assertTrue(result.timed_out)
+        self.assertEqual(result.returncodes, [TIMEOUT_RETURNCODE, 0])
+
+    def test_shell_timeout(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pid_file = os.path.join(tmp, "pid")
+            sh = ShellSession()
+            start = time.monotonic()
+            result = sh.run(f"echo started; sleep 30 & echo $! > {pid_file}; wait", capture=True, timeout=0.5)
+            self.assertLess(time.monotonic() - start, 5)
+            self.assertTrue(result.timed_out)
+            self.assertEqual(result.returncode, TIMEOUT_RETURNCODE)
+            self.assertEqual(result.stdout, "started\n")
+            self.assertTrue(sh.closed)
+            with open(pid_file) as f:
+                pid = int(f.read())
+            time.sleep(0.1)
+            self.assertFalse(self._alive(pid))
+            sh.close()
+
+    def test_task_timeout_covers_pipe_and_shell(self):
+        for func in (lambda ctx: ctx.pipe(["sleep 30"]), lambda ctx: ctx.shell().run("sleep 30")):
+            task = TaskDefinition(func=func, module="test", name="test", filename=__file__, dir=os.curdir, timeout=0.3)
+            start = time.monotonic()
+            self.assertEqual(_run_task(task, {}), TIMEOUT_RETURNCODE)
+            self.assertLess(time.monotonic() - start, 5)
+
+
+class TestRunMetrics(unittest.TestCase):
+    def _metrics(self):
+        metrics = RunMetrics()
+        with metrics.phase("discovery"):
+            pass
+        metrics.add_task(TaskMetrics('test[name="a"]', "test", 1.5, 2, "failed", 3))
+        metrics.exit_code = 2
+        return metrics
+
+    def test_openmetrics(self):
+        text = self._metrics().to_openmetrics()
+        self.assertIn('task_duration_seconds{task="test",instance="test[name=\\"a\\"]",status="failed"} 1.5\n', text)
+        self.assertIn('task_subprocesses{task="test",instance="test[name=\\"a\\"]",status="failed"} 3\n', text)
+        self.assertIn("task_run_exit_code 2\n", text)
+        self.assertIn('task_phase_duration_seconds{phase="discovery"}', text)
+        self.assertTrue(text.endswith("# EOF\n"))
+
+    def test_json_lines(self):
+        lines = [json.loads(line) for line in self._metrics().to_json_lines().splitlines()]
+        self.assertEqual([line["type"] for line in lines], ["task", "run"])
+        self.assertEqual(lines[0]["exit_code"], 2)
+        self.assertEqual(lines[0]["subprocesses"], 3)
+        self.assertEqual(lines[1]["exit_code"], 2)
+        self.assertIn("discovery", lines[1]["phases"])
+
+    def test_write(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            metrics = self._metrics()
+            metrics.write(os.path.join(tmp, "task.prom"))
+            metrics.write(os.path.join(tmp, "task.jsonl"))
+            metrics.write(os.path.join(tmp, "task.jsonl"))
+            self.assertEqual(sorted(os.listdir(tmp)), ["task.jsonl", "task.prom"])
+            with open(os.path.join(tmp, "task.jsonl")) as f:
+                self.assertEqual(len(f.readlines()), 4)
+
+    def test_run_task(self):
+        metrics = RunMetrics()
+        task = TaskDefinition(
+            func=lambda ctx: ctx.exec("true"), module="test", name="test", filename=__file__, dir=os.curdir
+        )
+        with mock.patch("__tasklib__._run_metrics", metrics):
+            self.assertEqual(_run_task(task, {}), 0)
+        self.assertEqual(len(metrics.tasks), 1)
+        self.assertEqual(metrics.tasks[0].status, "ok")
+        self.assertEqual(metrics.tasks[0].subprocesses, 1)
+
+    def test_exit_code_when_task_raises(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, "__task__.py"), "w") as f:
+                f.write("def _boom(ctx):\n    raise RuntimeError('boom')\n\n")
+                f.write("def configure(builder):\n    builder.add_task(__name__, 'boom', _boom)\n")
+            env = {**os.environ, "PYTHONPATH": os.path.dirname(os.path.abspath(__file__)), "LOG_LEVEL": "QUIET"}
+            cmd = [sys.executable, "-m", "__tasklib__", "--metrics", "m.jsonl", "boom"]
+            proc = subprocess.run(cmd, cwd=tmp, env=env, capture_output=True)
+            self.assertEqual(proc.returncode, 1)
+            with open(os.path.join(tmp, "m.jsonl")) as f:
+                lines = [json.loads(line) for line in f]
+        self.assertEqual(lines[0]["status"], "failed")
+        self.assertEqual(lines[-1]["type"], "run")
+        self.assertEqual(lines[-1]["exit_code"], 1)
+
+
+class TestAsyncTasks(unittest.TestCase):
+    def tearDown(self):
+        _close_event_loop()
+
+    def _task(self, name, func, deps=[], timeout=None):
+        return TaskDefinition(
+            func=func, module="test", name=name, filename=__file__, dir=os.curdir, deps=deps, timeout=timeout
+        )
+
+    def test_aexec(self):
+        result = _run_until_complete(aexec(["sh", "-c", "cat; echo err >&2; exit 3"], capture=True, input="hi"))
+        self.assertEqual(result.returncode, 3)
+        self.assertEqual(result.stdout, "hi")
+        self.assertEqual(result.stderr, "err\n")
+
+    def test_aexec_timeout(self):
+        result = _run_until_complete(aexec("sleep 30", capture=True, timeout=0.2))
+        self.assertTrue(result.timed_out)
+        self.assertEqual(result.returncode, TIMEOUT_RETURNCODE)
+
+    def test_independent_tasks_overlap(self):
+        order = []
+
+        async def _slow(ctx):
+            order.append("slow:start")
+            await ctx.aexec("sleep 0.3")
+            order.append("slow:end")
+
+        async def _fast(ctx):
+            order.append("fast")
+            return 5
+
+        async def _after(ctx):
+            order.append("after")
+
+        batch = [
+            (self._task("slow", _slow), [{}]),
+            (self._task("fast", _fast), [{}]),
+            (self._task("after", _after, deps=["slow"]), [{}]),
+        ]
+        codes = _run_until_complete(_run_async_tasks(batch, jobs=4))
+        self.assertEqual(codes, [None, 5, None])
+        self.assertEqual(order, ["slow:start", "fast", "slow:end", "after"])
+
+    def test_run_task(self):
+        async def _func(ctx):
+            return await ctx.aexec("true")
+
+        self.assertEqual(_run_task(self._task("test", _func), {}), 0)
+
+    def test_task_timeout(self):
+        async def _func(ctx):
+            await asyncio.sleep(30)
+
+        start = time.monotonic()
+        self.assertEqual(_run_task(self._task("test", _func, timeout=0.2), {}), TIMEOUT_RETURNCODE)
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_matrix(self):
+        running = []
+
+        async def _func(ctx):
+            running.append(ctx.args["n"])
+            await asyncio.sleep(0.1)
+            return 1 if ctx.args["n"] == "b" else 0
+
+        instances = [{"n": "a"}, {"n": "b"}, {"n": "c"}]
+        self.assertEqual(_run_matrix(self._task("test", _func), instances, jobs=3), 1)
+        self.assertEqual(sorted(running), ["a", "b", "c"])
+
+
+class TestRemoteCache(unittest.TestCase):
+    def setUp(self):
+        from __taskcache__ import CacheServer
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.project = os.path.join(self.tmp.name, "project")
+        os.makedirs(os.path.join(self.project, "src"))
+        self._write("src/main.txt", "v1")
+        self.server = CacheServer(os.path.join(self.tmp.name, "cache")).start()
+        self.calls = 0
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def _write(self, path, content):
+        with open(os.path.join(self.project, path), "w") as f:
+            f.write(content)
+
+    def _read(self, path):
+        with open(os.path.join(self.project, path)) as f:
+            return f.read()
+
+    def _build(self, ctx):
+        self.calls += 1
+        os.makedirs(os.path.join(ctx.project_dir, "dist"), exist_ok=True)
+        with open(os.path.join(ctx.project_dir, "dist", "out.txt"), "w") as f:
+            f.write(self._read("src/main.txt").upper())
+
+    def _task(self):
+        return TaskDefinition(
+            func=self._build,
+            module="test",
+            name="build",
+            filename=__file__,
+            dir=self.project,
+            inputs=["src/**/*.txt"],
+            outputs=["dist"],
+        )
+
+    def _run(self, url=None):
+        cache = RemoteCache(url or self.server.url)
+        metrics = RunMetrics()
+        with mock.patch("__tasklib__._remote_cache", cache), mock.patch("__tasklib__._run_metrics", metrics):
+            code = _run_task(self._task(), {})
+        cache.close()
+        return code, metrics.tasks[0].status
+
+    def test_hit_restores_outputs(self):
+        self.assertEqual(self._run(), (None, "ok"))
+        os.remove(os.path.join(self.project, "dist", "out.txt"))
+
+        self.assertEqual(self._run(), (0, "cached"))
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self._read("dist/out.txt"), "V1")
+
+    def test_input_change_misses(self):
+        self._run()
+        self._write("src/main.txt", "v2")
+        self.assertEqual(self._run(), (None, "ok"))
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(self._read("dist/out.txt"), "V2")
+
+    def test_cache_key(self):
+        task = self._task()
+        key = _cache_key(task, {})
+        self.assertEqual(key, _cache_key(task, {}))
+        self.assertNotEqual(key, _cache_key(task, {"a": "1"}))
+        with mock.patch.dict(os.environ, {"MODE": "release"}):
+            self.assertEqual(key, _cache_key(task, {}))
+            self.assertNotEqual(key, _cache_key(task._replace(env=["MODE"]), {}))
+
+    def test_unavailable(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.assertEqual(self._run(url="http://127.0.0.1:9"), (None, "ok"))
+        self.assertEqual(self.calls, 1)
+
+    def test_server_rejects_bad_digest(self):
+        request = urllib.request.Request(f"{self.server.url}/cas/{'0' * 64}", data=b"data", method="PUT")
+        with self.assertRaises(urllib.error.HTTPError) as ctx:
+            urllib.request.urlopen(request)
+        self.assertEqual(ctx.exception.code, 400)
+
+    def test_close_gives_up_on_slow_uploads(self):
+        release = threading.Event()
+        cache = RemoteCache(self.server.url)
+        def upload(key, archive, *args):
+            with archive:
+                release.wait(10)
+
+        with mock.patch.object(cache, "_upload", side_effect=upload):
+            for n in range(3):
+                cache.put(f"key{n}", self.project, [], 0)
+            pending = list(cache._pending)
+            start = time.monotonic()
+            with self.assertLogs("task", "WARNING") as logs:
+                cache.close(timeout=0.2)
+            self.assertLess(time.monotonic() - start, 2)
+            self.assertIn("Gave up on 3 remote cache uploads", logs.output[0])
+            # the queued upload never starts and the running ones can't hold up exit
+            self.assertTrue(pending[2].cancelled())
+            self.assertTrue(all(w.daemon for w in cache._workers))
+            release.set()
+
+
+class _DroppingHandler(socketserver.StreamRequestHandler):
+    # offers server.tasks, then hangs up once it has held a task for server.delay seconds
+    def handle(self):
+        self.wfile.write(json.dumps({"op": "hello", "tasks": self.server.tasks}).encode() + b"\n")
+        self.wfile.flush()
+        self.rfile.readline()
+        time.sleep(getattr(self.server, "delay", 0))
+        self.server.dropped += 1
+
+
+class _BadReplyHandler(socketserver.StreamRequestHandler):
+    # offers server.tasks and answers every task with a done message that has no exit code
+    def handle(self):
+        self.wfile.write(json.dumps({"op": "hello", "tasks": self.server.tasks}).encode() + b"\n")
+        self.wfile.flush()
+        for line in self.rfile:
+            self.wfile.write(json.dumps({"op": "done", "id": json.loads(line)["id"]}).encode() + b"\n")
+            self.wfile.flush()
+            self.server.dropped += 1
+
+
+class TestDistributed(unittest.TestCase):
+    def setUp(self):
+        self.ran = []
+        self.lock = threading.Lock()
+        self.tasks = {
+            "prep": self._task("prep", self._record),
+            "test": self._task("test", self._test, deps=["prep"], matrix={"n": ["1", "2", "3"]}),
+        }
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def _task(self, name, func, deps=[], matrix={}):
+        return TaskDefinition(
+            func=func, module="test", name=name, filename=__file__, dir=os.curdir, deps=deps, matrix=matrix
+        )
+
+    def _record(self, ctx):
+        with self.lock:
+            self.ran.append(ctx.args.get("n", "prep"))
+
+    def _test(self, ctx):
+        self._record(ctx)
+        return 2 if ctx.args["n"] == "2" else 0
+
+    def _serve(self, server):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.servers.append(server)
+        host, port = server.server_address[:2]
+        return f"{host}:{port}"
+
+    def _worker(self):
+        return self._serve(WorkerServer(self.tasks, ("127.0.0.1", 0)))
+
+    def _dropping(self, delay=0, handler=None):
+        server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), handler or _DroppingHandler)
+        server.dropped = 0
+        server.delay = delay
+        server.tasks = sorted(self.tasks)
+        return server
+
+    def _unused_address(self):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            return "127.0.0.1:%d" % sock.getsockname()[1]
+
+    def test_runs_on_workers(self):
+        workers = [self._worker(), self._worker()]
+        code = _run_distributed(["prep", "test"], self.tasks, {}, workers)
+        self.assertEqual(code, 2)
+        self.assertEqual(self.ran[0], "prep")
+        self.assertEqual(sorted(self.ran[1:]), ["1", "2", "3"])
+
+    def test_logs_are_forwarded(self):
+        tasks = {"hello": self._task("hello", lambda ctx: ctx.log.warning("hello from worker"))}
+        address = self._serve(WorkerServer(tasks, ("127.0.0.1", 0)))
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logging.getLogger("test").addHandler(handler)
+        try:
+            self.assertEqual(_run_distributed(["hello"], tasks, {}, [address]), 0)
+        finally:
+            logging.getLogger("test").removeHandler(handler)
+        # once where the worker logged it and once when the coordinator re-logged it
+        self.assertEqual([r.getMessage() for r in records], ["hello from worker"] * 2)
+        self.assertTrue(records[1].threadName.startswith("worker-"))
+
+    def test_failed_worker_is_retried_elsewhere(self):
+        dropping = self._dropping()
+        workers = [self._serve(dropping), self._unused_address(), self._worker()]
+        code = _run_distributed(["prep", "test"], self.tasks, {"test": {"n": "1"}}, workers)
+        self.assertEqual(code, 0)
+        self.assertEqual(sorted(self.ran), ["1", "prep"])
+
+    def test_worker_lost_after_others_went_idle(self):
+        def nap(ctx):
+            time.sleep(0.2)
+            self._record(ctx)
+
+        tasks = {"a": self._task("a", nap), "b": self._task("b", nap)}
+        self.tasks = tasks
+        dropping = self._dropping(delay=0.5)
+        workers = [self._worker(), self._serve(dropping)]
+        self.assertEqual(_run_distributed(["a", "b"], tasks, {}, workers), 0)
+        self.assertEqual(dropping.dropped, 1)
+        self.assertEqual(len(self.ran), 2)
+
+    def test_bad_reply(self):
+        # the idle worker offers nothing so it would wait on the unit forever if it stayed running
+        dropping = self._dropping(handler=_BadReplyHandler)
+        idle = self._serve(WorkerServer({}, ("127.0.0.1", 0)))
+        self.assertEqual(_run_distributed(["prep"], self.tasks, {}, [self._serve(dropping), idle]), 1)
+        self.assertEqual(dropping.dropped, 1)
+        self.assertEqual(self.ran, [])
+
+    def test_bad_reply_is_retried_elsewhere(self):
+        dropping = self._dropping(handler=_BadReplyHandler)
+        workers = [self._serve(dropping), self._worker()]
+        code = _run_distributed(["prep", "test"], self.tasks, {"test": {"n": "1"}}, workers)
+        self.assertEqual(code, 0)
+        self.assertEqual(sorted(self.ran), ["1", "prep"])
+
+    def test_routes_by_offered_tasks(self):
+        prep_only = self._serve(WorkerServer({"prep": self.tasks["prep"]}, ("127.0.0.1", 0)))
+        code = _run_distributed(["prep", "test"], self.tasks, {"test": {"n": "1"}}, [prep_only, self._worker()])
+        self.assertEqual(code, 0)
+        self.assertEqual(sorted(self.ran), ["1", "prep"])
+
+    def test_task_not_offered(self):
+        prep_only = self._serve(WorkerServer({"prep": self.tasks["prep"]}, ("127.0.0.1", 0)))
+        with self.assertLogs("task", "ERROR") as logs:
+            code = _run_distributed(["prep", "test"], self.tasks, {"test": {"n": "1"}}, [prep_only])
+        self.assertEqual(code, 1)
+        self.assertEqual(self.ran, ["prep"])
+        self.assertIn("No worker offers task test", logs.output[0])
+
+    def test_no_workers(self):
+        self.assertEqual(_run_distributed(["prep"], self.tasks, {}, [self._unused_address()]), 1)
+        self.assertEqual(self.ran, [])
+
 
 if __name__ == "__main__":
     unittest.main()
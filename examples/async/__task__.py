@@ -0,0 +1,22 @@
+import asyncio
+from __tasklib__ import TaskContext, TaskBuilder
+
+
+async def _wait(ctx: TaskContext):
+    ctx.log.info(f"Waiting on {ctx.args.get('service', 'db')}")
+    ret = await ctx.aexec("sleep 1")
+    ctx.log.info("Ready")
+    return ret
+
+
+async def _poll(ctx: TaskContext):
+    for i in range(3):
+        ctx.log.info(f"Poll {i}")
+        await asyncio.sleep(0.3)
+
+
+def configure(builder: TaskBuilder):
+    module_name = "async"
+    builder.add_task(module_name, "async:wait", _wait)
+    builder.add_task(module_name, "async:poll", _poll)
+    builder.add_task(module_name, "async:all", lambda ctx: ctx.log.info("Done"), deps=["async:wait", "async:poll"])
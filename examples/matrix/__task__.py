@@ -0,0 +1,18 @@
+import time
+from __tasklib__ import TaskContext, TaskBuilder
+
+
+def _test(ctx: TaskContext):
+    ctx.log.info(f"Testing python {ctx.args['py']} against {ctx.args['db']}")
+    time.sleep(1)
+    return 1 if ctx.args["db"] == "mysql" and ctx.args["py"] == "3.9" else 0
+
+
+def configure(builder: TaskBuilder):
+    module_name = "matrix"
+    builder.add_task(
+        module_name,
+        "matrix:test",
+        _test,
+        matrix={"py": ["3.9", "3.10", "3.11"], "db": ["pg", "mysql"]},
+    )